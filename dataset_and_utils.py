@@ -1,4 +1,6 @@
+import hashlib
 import os
+import time
 from typing import Dict, List, Optional, Tuple
 
 import numpy as np
@@ -36,6 +38,9 @@ def prepare_mask(
     return image
 
 
+LATENT_CACHE_FILE = "latents_cache.safetensors"
+
+
 class PreprocessedDataset(Dataset):
     def __init__(
         self,
@@ -50,6 +55,8 @@ class PreprocessedDataset(Dataset):
         text_dropout: float = 0.0,
         scale_vae_latents: bool = True,
         substitute_caption_map: Dict[str, str] = {},
+        vae_batch_size: int = 8,
+        persist_cache: bool = True,
     ):
         super().__init__()
 
@@ -89,40 +96,28 @@ class PreprocessedDataset(Dataset):
         self.size = size
 
         if do_cache:
-            self.vae_latents = []
-            self.tokens_tuple = []
-            self.masks = []
-
             self.do_cache = True
 
             print("Captions to train on: ")
-            for idx in range(len(self.data)):
-                token, vae_latent, mask = self._process(idx)
-                self.vae_latents.append(vae_latent)
-                self.tokens_tuple.append(token)
-                self.masks.append(mask)
+            for caption in self.caption:
+                print(caption)
+
+            cache_path = os.path.join(os.path.dirname(self.csv_path), LATENT_CACHE_FILE)
+            cache_key = self._cache_key()
+            if not (persist_cache and self._load_cache(cache_path, cache_key)):
+                self._build_cache(vae_batch_size)
+                if persist_cache:
+                    self._save_cache(cache_path, cache_key)
 
             del self.vae_encoder
 
         else:
             self.do_cache = False
 
-    @torch.no_grad()
-    def _process(
-        self, idx: int
-    ) -> Tuple[Tuple[torch.Tensor, torch.Tensor], torch.Tensor, torch.Tensor]:
-        image_path = self.image_path[idx]
-        image_path = os.path.join(os.path.dirname(self.csv_path), image_path)
-
-        image = PIL.Image.open(image_path).convert("RGB")
-        image = prepare_image(image, self.size, self.size).to(
-            dtype=self.vae_encoder.dtype, device=self.vae_encoder.device
-        )
-
-        caption = self.caption[idx]
-
-        print(caption)
+    def _full_path(self, path: str) -> str:
+        return os.path.join(os.path.dirname(self.csv_path), path)
 
+    def _tokenize(self, caption: str) -> Tuple[torch.Tensor, torch.Tensor]:
         # tokenizer_1
         ti1 = self.tokenizer_1(
             caption,
@@ -142,33 +137,131 @@ class PreprocessedDataset(Dataset):
             return_tensors="pt",
         ).input_ids
 
-        vae_latent = self.vae_encoder.encode(image).latent_dist.sample()
-
-        if self.scale_vae_latents:
-            vae_latent = vae_latent * self.vae_encoder.config.scaling_factor
+        return ti1.squeeze(), ti2.squeeze()
 
+    def _load_mask(self, idx: int, latent_hw: Tuple[int, int]) -> torch.Tensor:
+        """
+        Returns the single channel mask of an image at latent resolution, shape (1, h, w).
+        """
         if self.mask_path is None:
-            mask = torch.ones_like(
-                vae_latent, dtype=self.vae_encoder.dtype, device=self.vae_encoder.device
-            )
+            return torch.ones((1, *latent_hw), dtype=torch.float32)
 
-        else:
-            mask_path = self.mask_path[idx]
-            mask_path = os.path.join(os.path.dirname(self.csv_path), mask_path)
+        mask = PIL.Image.open(self._full_path(self.mask_path[idx]))
+        mask = prepare_mask(mask, self.size, self.size)
+        mask = torch.nn.functional.interpolate(mask, size=latent_hw, mode="nearest")
+        return mask.squeeze(0)
 
-            mask = PIL.Image.open(mask_path)
-            mask = prepare_mask(mask, self.size, self.size).to(
-                dtype=self.vae_encoder.dtype, device=self.vae_encoder.device
+    @torch.no_grad()
+    def _encode(self, indices: List[int]) -> torch.Tensor:
+        images = [
+            prepare_image(
+                PIL.Image.open(self._full_path(self.image_path[idx])).convert("RGB"),
+                self.size,
+                self.size,
             )
+            for idx in indices
+        ]
+        images = torch.cat(images).to(
+            dtype=self.vae_encoder.dtype, device=self.vae_encoder.device
+        )
 
-            mask = torch.nn.functional.interpolate(
-                mask, size=(vae_latent.shape[-2], vae_latent.shape[-1]), mode="nearest"
-            )
-            mask = mask.repeat(1, vae_latent.shape[1], 1, 1)
+        vae_latent = self.vae_encoder.encode(images).latent_dist.sample()
 
-        assert len(mask.shape) == 4 and len(vae_latent.shape) == 4
+        if self.scale_vae_latents:
+            vae_latent = vae_latent * self.vae_encoder.config.scaling_factor
 
-        return (ti1.squeeze(), ti2.squeeze()), vae_latent.squeeze(), mask.squeeze()
+        return vae_latent
+
+    @torch.no_grad()
+    def _process(
+        self, idx: int
+    ) -> Tuple[Tuple[torch.Tensor, torch.Tensor], torch.Tensor, torch.Tensor]:
+        tokens = self._tokenize(self.caption[idx])
+
+        vae_latent = self._encode([idx]).squeeze(0)
+        mask = self._load_mask(idx, vae_latent.shape[-2:]).to(
+            dtype=self.vae_encoder.dtype, device=self.vae_encoder.device
+        )
+
+        assert len(mask.shape) == 3 and len(vae_latent.shape) == 3
+
+        return tokens, vae_latent, mask.expand_as(vae_latent)
+
+    def _build_cache(self, vae_batch_size: int):
+        """
+        Encodes all images through the VAE, `vae_batch_size` at a time. Latents, masks and
+        token ids are kept stacked on the CPU.
+        """
+        latents = []
+        for start in range(0, len(self.data), vae_batch_size):
+            indices = list(range(start, min(start + vae_batch_size, len(self.data))))
+            latents.append(self._encode(indices).cpu())
+        self.vae_latents = torch.cat(latents)
+
+        latent_hw = self.vae_latents.shape[-2:]
+        self.masks = torch.stack(
+            [self._load_mask(idx, latent_hw) for idx in range(len(self.data))]
+        ).to(self.vae_latents.dtype)
+
+        tokens = [self._tokenize(caption) for caption in self.caption]
+        self.tokens_1 = torch.stack([t[0] for t in tokens])
+        self.tokens_2 = torch.stack([t[1] for t in tokens])
+
+    def _cache_key(self) -> str:
+        """
+        Hash of everything the cached latents depend on: image and mask contents, captions,
+        tokenizers, resolution and the VAE (its name or path, config and dtype).
+        """
+        h = hashlib.sha256()
+        h.update(
+            repr(
+                (
+                    self.size,
+                    self.scale_vae_latents,
+                    sorted(dict(self.vae_encoder.config).items()),
+                    str(self.vae_encoder.dtype),
+                    len(self.tokenizer_1),
+                    len(self.tokenizer_2),
+                    list(self.caption),
+                )
+            ).encode("utf-8")
+        )
+        paths = list(self.image_path)
+        if self.mask_path is not None:
+            paths += list(self.mask_path)
+        for path in paths:
+            with open(self._full_path(path), "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        return h.hexdigest()
+
+    def _load_cache(self, cache_path: str, cache_key: str) -> bool:
+        if not os.path.exists(cache_path):
+            return False
+
+        with safe_open(cache_path, framework="pt", device="cpu") as f:
+            if f.metadata().get("cache_key") != cache_key:
+                print(f"Latent cache {cache_path} is stale, re-encoding")
+                return False
+            self.vae_latents = f.get_tensor("latents")
+            self.masks = f.get_tensor("masks")
+            self.tokens_1 = f.get_tensor("tokens_1")
+            self.tokens_2 = f.get_tensor("tokens_2")
+
+        print(f"Loaded {len(self.vae_latents)} cached latents from {cache_path}")
+        return True
+
+    def _save_cache(self, cache_path: str, cache_key: str):
+        save_file(
+            {
+                "latents": self.vae_latents.contiguous(),
+                "masks": self.masks.contiguous(),
+                "tokens_1": self.tokens_1.contiguous(),
+                "tokens_2": self.tokens_2.contiguous(),
+            },
+            cache_path,
+            metadata={"cache_key": cache_key},
+        )
+        print(f"Saved latent cache to {cache_path}")
 
     def __len__(self) -> int:
         return len(self.data)
@@ -177,7 +270,10 @@ class PreprocessedDataset(Dataset):
         self, idx: int
     ) -> Tuple[Tuple[torch.Tensor, torch.Tensor], torch.Tensor, torch.Tensor]:
         if self.do_cache:
-            return self.tokens_tuple[idx], self.vae_latents[idx], self.masks[idx]
+            vae_latent = self.vae_latents[idx]
+            # masks are stored with a single channel and only broadcast here
+            mask = self.masks[idx].expand_as(vae_latent)
+            return (self.tokens_1[idx], self.tokens_2[idx]), vae_latent, mask
         else:
             return self._process(idx)
 
@@ -294,6 +390,10 @@ class TokenEmbeddingsHandler:
         self.inserting_toks: Optional[List[str]] = None
         self.embeddings_settings = {}
 
+        # set to record the duration of every retract_embeddings call
+        self.profile_retract = False
+        self.retract_timings: List[float] = []
+
     def initialize_new_tokens(self, inserting_toks: List[str]):
         idx = 0
         for tokenizer, text_encoder in zip(self.tokenizers, self.text_encoders):
@@ -338,6 +438,9 @@ class TokenEmbeddingsHandler:
             inu[self.train_ids] = False
 
             self.embeddings_settings[f"index_no_updates_{idx}"] = inu
+            self.embeddings_settings[f"train_ids_{idx}"] = torch.tensor(
+                self.train_ids, dtype=torch.long, device=text_encoder.device
+            )
 
             print(self.embeddings_settings[f"index_no_updates_{idx}"].shape)
 
@@ -390,9 +493,14 @@ class TokenEmbeddingsHandler:
     def _load_embeddings(self, loaded_embeddings, tokenizer, text_encoder):
         # Assuming new tokens are of the format <s_i>
         self.inserting_toks = [f"<s{i}>" for i in range(loaded_embeddings.shape[0])]
-        special_tokens_dict = {"additional_special_tokens": self.inserting_toks}
-        tokenizer.add_special_tokens(special_tokens_dict)
-        text_encoder.resize_token_embeddings(len(tokenizer))
+        # loading again (e.g. swapping LoRAs in the predictor) only writes the rows
+        registered = tokenizer.additional_special_tokens
+        missing = [tok for tok in self.inserting_toks if tok not in registered]
+        if missing:
+            special_tokens_dict = {"additional_special_tokens": registered + missing}
+            tokenizer.add_special_tokens(special_tokens_dict)
+        if text_encoder.get_input_embeddings().num_embeddings != len(tokenizer):
+            text_encoder.resize_token_embeddings(len(tokenizer))
 
         self.train_ids = tokenizer.convert_tokens_to_ids(self.inserting_toks)
         assert self.train_ids is not None, "New tokens could not be converted to IDs."
@@ -402,32 +510,33 @@ class TokenEmbeddingsHandler:
 
     @torch.no_grad()
     def retract_embeddings(self):
+        if self.profile_retract:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+
         for idx, text_encoder in enumerate(self.text_encoders):
-            index_no_updates = self.embeddings_settings[f"index_no_updates_{idx}"]
-            text_encoder.text_model.embeddings.token_embedding.weight.data[
-                index_no_updates
-            ] = (
-                self.embeddings_settings[f"original_embeddings_{idx}"][index_no_updates]
-                .to(device=text_encoder.device)
-                .to(dtype=text_encoder.dtype)
-            )
+            weight = text_encoder.text_model.embeddings.token_embedding.weight.data
+            train_ids = self.embeddings_settings[f"train_ids_{idx}"]
 
             # for the parts that were updated, we need to normalize them
             # to have the same std as before
             std_token_embedding = self.embeddings_settings[f"std_token_embedding_{idx}"]
 
-            index_updates = ~index_no_updates
-            new_embeddings = (
-                text_encoder.text_model.embeddings.token_embedding.weight.data[
-                    index_updates
-                ]
-            )
+            new_embeddings = weight.index_select(0, train_ids)
             off_ratio = std_token_embedding / new_embeddings.std()
-
-            new_embeddings = new_embeddings * (off_ratio**0.1)
-            text_encoder.text_model.embeddings.token_embedding.weight.data[
-                index_updates
-            ] = new_embeddings
+            new_embeddings.mul_(off_ratio**0.1)
+
+            # AdamW's decoupled weight decay touches every row, so the whole table is
+            # restored with one contiguous in-place copy from the pre-cast originals,
+            # then the trained rows are put back.
+            weight.copy_(self.embeddings_settings[f"original_embeddings_{idx}"])
+            weight.index_copy_(0, train_ids, new_embeddings)
+
+        if self.profile_retract:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self.retract_timings.append(time.perf_counter() - start)
 
     def load_embeddings(self, file_path: str):
         with safe_open(file_path, framework="pt", device=self.device.type) as f:
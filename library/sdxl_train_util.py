@@ -302,6 +302,13 @@ def add_sdxl_training_arguments(parser: argparse.ArgumentParser):
         action="store_true",
         help="cache text encoder outputs to disk / text encoderの出力をディスクにキャッシュする",
     )
+    parser.add_argument(
+        "--text_encoder_cache_batch_size",
+        type=int,
+        default=None,
+        help="batch size for caching text encoder outputs, default is train_batch_size / "
+        + "text encoderの出力のキャッシュ時のバッチサイズ、省略時はtrain_batch_size",
+    )
 
 
 def verify_sdxl_training_args(args: argparse.Namespace, supportTextEncoderCaching: bool = True):
@@ -3,7 +3,12 @@
 import argparse
 import ast
 import asyncio
+import atexit
+import collections
+import concurrent.futures
+import copy
 import importlib
+import itertools
 import json
 import pathlib
 import re
@@ -104,6 +109,108 @@ IMAGE_TRANSFORMS = transforms.Compose(
 )
 
 TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX = "_te_outputs.npz"
+# text encoder outputs cached to disk are shared by the images with the same tokenized caption, one file per caption
+# in this subdirectory of the image directory
+TEXT_ENCODER_OUTPUTS_CACHE_DIR = ".te_outputs"
+
+# per-directory index of image sizes and captions, reused while the files are unchanged
+DATASET_INDEX_FILE = ".dataset_index.json"
+DATASET_INDEX_VERSION = 1
+IMAGE_SIZE_PROBE_WORKERS = 16
+
+# latents cached to disk are appended to shard files in this subdirectory of the image directory
+LATENTS_STORE_DIR = ".latents"
+LATENTS_STORE_VERSION = 1
+LATENTS_SHARD_SIZE = 1 << 30  # bytes
+# a writer's shards are rewritten when less than this part of their bytes is still referenced by the index
+LATENTS_STORE_COMPACT_RATIO = 0.5
+
+
+class DatasetIndex:
+    """
+    Stats of every file in an image directory, taken in one scandir pass, plus the image sizes and captions read
+    from them. Entries are kept in `DATASET_INDEX_FILE` in the directory with the mtime and size of the file they were
+    read from, so later runs only read the files that changed.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.path = os.path.join(directory, DATASET_INDEX_FILE)
+        self.images: Dict[str, dict] = {}
+        self.captions: Dict[str, dict] = {}
+        self.dirty = False
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == DATASET_INDEX_VERSION:
+                    self.images = data["images"]
+                    self.captions = data["captions"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"ignore broken dataset index / データセットのインデックスが壊れているため無視します: {self.path}, {e}")
+
+        self.stats: Dict[str, List[int]] = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                self.stats[entry.name] = [stat.st_mtime_ns, stat.st_size]
+
+        # forget deleted files
+        for table in (self.images, self.captions):
+            for name in [name for name in table if name not in self.stats]:
+                del table[name]
+                self.dirty = True
+
+    def image_paths(self) -> List[str]:
+        # same as glob_images(directory, "*")
+        names = [name for name in self.stats if os.path.splitext(name)[1] in IMAGE_EXTENSIONS]
+        return sorted(os.path.join(self.directory, name) for name in names)
+
+    def _get(self, table, name):
+        entry = table.get(name)
+        if entry is None or entry["stat"] != self.stats.get(name):
+            return None
+        return entry
+
+    def image_size(self, name: str) -> Optional[Tuple[int, int]]:
+        entry = self._get(self.images, name)
+        return None if entry is None else tuple(entry["size"])
+
+    def set_image_size(self, name: str, size: Tuple[int, int]):
+        self.images[name] = {"stat": self.stats.get(name), "size": list(size)}
+        self.dirty = True
+
+    def has_file(self, name: str) -> bool:
+        return name in self.stats
+
+    def name_of(self, path: str) -> Optional[str]:
+        # file name of `path` if it is in this directory
+        if os.path.normpath(os.path.dirname(path)) != os.path.normpath(self.directory):
+            return None
+        return os.path.basename(path)
+
+    def caption(self, name: str) -> Optional[str]:
+        entry = self._get(self.captions, name)
+        return None if entry is None else entry["caption"]
+
+    def set_caption(self, name: str, caption: str):
+        self.captions[name] = {"stat": self.stats.get(name), "caption": caption}
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": DATASET_INDEX_VERSION, "images": self.images, "captions": self.captions}, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            print(f"could not write dataset index / データセットのインデックスを書き込めません: {self.path}, {e}")
 
 
 class ImageInfo:
@@ -119,6 +226,7 @@ class ImageInfo:
         self.latents: torch.Tensor = None
         self.latents_flipped: torch.Tensor = None
         self.latents_npz: str = None
+        self.latents_store: Optional["LatentStore"] = None  # set when latents are cached to a LatentStore
         self.latents_original_size: Tuple[int, int] = None  # original image size, not latents size
         self.latents_crop_ltrb: Tuple[int, int] = None  # crop left top right bottom in original pixel size, not latents size
         self.cond_img_path: str = None
@@ -549,6 +657,57 @@ class BaseDataset(torch.utils.data.Dataset):
         # caching
         self.caching_mode = None  # None, 'latents', 'text'
 
+        # image sizes and captions are read through a per-directory DatasetIndex
+        self.use_dataset_index = True
+        self.dataset_indexes: Dict[str, DatasetIndex] = {}
+        self.latent_stores: Dict[str, LatentStore] = {}
+
+    def get_dataset_index(self, directory: str) -> Optional[DatasetIndex]:
+        if not self.use_dataset_index or not os.path.isdir(directory):
+            return None
+        key = os.path.normpath(directory)
+        if key not in self.dataset_indexes:
+            self.dataset_indexes[key] = DatasetIndex(directory)
+        return self.dataset_indexes[key]
+
+    def get_latent_store(self, directory: str, writer: str = "0") -> "LatentStore":
+        key = os.path.normpath(directory)
+        if key not in self.latent_stores:
+            self.latent_stores[key] = LatentStore(directory, writer)
+        return self.latent_stores[key]
+
+    def save_dataset_indexes(self):
+        for index in self.dataset_indexes.values():
+            index.save()
+
+    def load_image_sizes(self):
+        """
+        Sets the image size of every image that has none yet, from the dataset index when the file is unchanged and
+        otherwise by reading the image header, in a thread pool.
+        """
+        pending = []
+        for info in self.image_data.values():
+            if info.image_size is not None:
+                continue
+            index = self.get_dataset_index(os.path.dirname(info.absolute_path))
+            name = os.path.basename(info.absolute_path)
+            size = index.image_size(name) if index is not None else None
+            if size is not None:
+                info.image_size = size
+            else:
+                pending.append((info, index, name))
+
+        print(f"loading image sizes: {len(self.image_data) - len(pending)} indexed, {len(pending)} to read.")
+        if pending:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_SIZE_PROBE_WORKERS) as executor:
+                sizes = executor.map(self.get_image_size, [info.absolute_path for info, _, _ in pending])
+                for (info, index, name), size in tqdm(zip(pending, sizes), total=len(pending)):
+                    info.image_size = size
+                    if index is not None:
+                        index.set_image_size(name, size)
+
+        self.save_dataset_indexes()
+
     def set_seed(self, seed):
         self.seed = seed
 
@@ -703,10 +862,7 @@ class BaseDataset(torch.utils.data.Dataset):
         bucketingを行わない場合も呼び出し必須（ひとつだけbucketを作る）
         min_size and max_size are ignored when enable_bucket is False
         """
-        print("loading image sizes.")
-        for info in tqdm(self.image_data.values()):
-            if info.image_size is None:
-                info.image_size = self.get_image_size(info.absolute_path)
+        self.load_image_sizes()
 
         if self.enable_bucket:
             print("make buckets")
@@ -816,29 +972,74 @@ class BaseDataset(torch.utils.data.Dataset):
             ]
         )
 
-    def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
-        # マルチGPUには対応していないので、そちらはtools/cache_latents.pyを使うこと
+    def cache_latents(
+        self,
+        vae,
+        vae_batch_size=1,
+        cache_to_disk=False,
+        is_main_process=True,
+        cache_format="store",
+        num_workers=2,
+        empty_cache=False,
+        num_processes=1,
+        process_index=0,
+        cache_dtype=None,
+        compress=False,
+    ):
+        """
+        cache_format is used with cache_to_disk: "store" appends the latents to a LatentStore per image directory,
+        "npz" writes an npz file next to each image. Valid npz files are moved into the store when it is used.
+        The latents are kept in memory and on disk as `cache_dtype` (float32 by default) and upcast when loaded,
+        `compress` compresses the npz files.
+
+        Images are loaded and cropped by `num_workers` dataloader workers while the vae encodes, and the results are
+        written to disk by a background thread. With cache_to_disk, `num_processes` processes can cache together:
+        each one takes every num_processes-th image, starting at `process_index`. Call it in every process and wait
+        for all of them before training. `empty_cache` empties the cuda cache after every batch, which saves memory
+        but is slow.
+        """
         print("caching latents.")
+        shard = cache_to_disk and num_processes > 1
+        caching_process = is_main_process or shard  # processes that encode latents
 
         image_infos = list(self.image_data.values())
 
-        # sort by resolution
-        image_infos.sort(key=lambda info: info.bucket_reso[0] * info.bucket_reso[1])
+        # sort by resolution, then by the crop and flip settings of the subset, which are per batch
+        def caching_settings(info):
+            subset = self.image_to_subset[info.image_key]
+            return subset.flip_aug, subset.random_crop
+
+        image_infos.sort(key=lambda info: (info.bucket_reso[0] * info.bucket_reso[1], info.bucket_reso, caching_settings(info)))
 
         # split by resolution
         batches = []
         batch = []
         print("checking cache validity...")
-        for info in tqdm(image_infos):
+        for i, info in enumerate(tqdm(image_infos)):
             subset = self.image_to_subset[info.image_key]
 
             if info.latents_npz is not None:  # fine tuning dataset
                 continue
 
             # check disk cache exists and size of latents
-            if cache_to_disk:
+            if cache_to_disk and cache_format == "store":
+                store = self.get_latent_store(os.path.dirname(info.absolute_path), str(process_index))
+                info.latents_store = store
+                if not caching_process or (shard and i % num_processes != process_index):  # store to info only
+                    continue
+
+                name = os.path.basename(info.absolute_path)
+                if store.is_expected(name, info.bucket_reso, subset.flip_aug):  # do not add to batch
+                    continue
+
+                npz_path = os.path.splitext(info.absolute_path)[0] + ".npz"
+                if is_disk_cached_latents_is_expected(info.bucket_reso, npz_path, subset.flip_aug):
+                    latents, original_size, crop_ltrb, flipped_latents = load_latents_from_disk(npz_path)
+                    store.put(name, latents, original_size, crop_ltrb, flipped_latents, cache_dtype)
+                    continue
+            elif cache_to_disk:
                 info.latents_npz = os.path.splitext(info.absolute_path)[0] + ".npz"
-                if not is_main_process:  # store to info only
+                if not caching_process or (shard and i % num_processes != process_index):  # store to info only
                     continue
 
                 cache_available = is_disk_cached_latents_is_expected(info.bucket_reso, info.latents_npz, subset.flip_aug)
@@ -846,8 +1047,10 @@ class BaseDataset(torch.utils.data.Dataset):
                 if cache_available:  # do not add to batch
                     continue
 
-            # if last member of batch has different resolution, flush the batch
-            if len(batch) > 0 and batch[-1].bucket_reso != info.bucket_reso:
+            # if last member of batch has different resolution or subset settings, flush the batch
+            if len(batch) > 0 and (
+                batch[-1].bucket_reso != info.bucket_reso or caching_settings(batch[-1]) != caching_settings(info)
+            ):
                 batches.append(batch)
                 batch = []
 
@@ -861,20 +1064,75 @@ class BaseDataset(torch.utils.data.Dataset):
         if len(batch) > 0:
             batches.append(batch)
 
-        if cache_to_disk and not is_main_process:  # if cache to disk, don't cache latents in non-main process, set to info only
+        # other processes write, re-cache and compact their latents meanwhile, so the indexes read so far may point at
+        # replaced or removed shards: they are read again on the first lookup after caching, once all processes finished
+        for store in self.latent_stores.values():
+            store.stale = True
+
+        if cache_to_disk and not caching_process:  # if cache to disk, don't cache latents in non-main process, set to info only
             return
 
-        # iterate batches: batch doesn't have image, image will be loaded in cache_batch_latents and discarded
+        # iterate batches: batch doesn't have image, image will be loaded by the dataloader and discarded
         print("caching latents...")
-        for batch in tqdm(batches, smoothing=1, total=len(batches)):
-            cache_batch_latents(vae, cache_to_disk, batch, subset.flip_aug, subset.random_crop)
+        flip_augs, random_crops = zip(*[caching_settings(batch[0]) for batch in batches]) if batches else ((), ())
+        loader = torch.utils.data.DataLoader(
+            LatentCachingDataset(batches, random_crops),
+            batch_size=None,
+            num_workers=num_workers,
+            pin_memory=torch.cuda.is_available(),
+        )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+            pending = collections.deque()
+            for batch_index, img_tensors, sizes in tqdm(loader, smoothing=1, total=len(batches)):
+                batch = batches[batch_index]
+                for info, (original_size, crop_ltrb) in zip(batch, sizes):
+                    info.latents_original_size = original_size
+                    info.latents_crop_ltrb = crop_ltrb
+                pending.append(
+                    encode_batch_latents(
+                        vae,
+                        cache_to_disk,
+                        batch,
+                        img_tensors,
+                        flip_augs[batch_index],
+                        writer,
+                        empty_cache,
+                        cache_dtype,
+                        compress,
+                    )
+                )
+                # bound the latents waiting to be written
+                while len(pending) > 4:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+
+        for store in self.latent_stores.values():
+            store.save()
 
     # weight_dtypeを指定するとText Encoderそのもの、およひ出力がweight_dtypeになる
     # SDXLでのみ有効だが、datasetのメソッドとする必要があるので、sdxl_train_util.pyではなくこちらに実装する
     # SD1/2に対応するにはv2のフラグを持つ必要があるので後回し
     def cache_text_encoder_outputs(
-        self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True
+        self,
+        tokenizers,
+        text_encoders,
+        device,
+        weight_dtype,
+        cache_to_disk=False,
+        is_main_process=True,
+        cache_dtype=None,
+        compress=False,
+        encode_batch_size=None,
     ):
+        """
+        The outputs are cached once per tokenized caption and shared by all images with that caption, the unique
+        captions are encoded `encode_batch_size` (default: the batch size) at a time. On disk they are written to
+        TEXT_ENCODER_OUTPUTS_CACHE_DIR, existing per image npz files are still used.
+
+        The outputs are kept in memory and on disk as `cache_dtype` (float32 on disk by default) and upcast when
+        loaded, `compress` compresses the npz files.
+        """
         assert len(tokenizers) == 2, "only support SDXL"
 
         # latentsのキャッシュと同様に、ディスクへのキャッシュに対応する
@@ -883,11 +1141,21 @@ class BaseDataset(torch.utils.data.Dataset):
         image_infos = list(self.image_data.values())
 
         print("checking cache existence...")
-        image_infos_to_cache = []
+        tokenized = {}  # caption -> (key, input_ids1, input_ids2)
+        infos_to_cache: Dict[str, List[ImageInfo]] = {}  # key -> images
         for info in tqdm(image_infos):
             # subset = self.image_to_subset[info.image_key]
+            if info.caption not in tokenized:
+                input_ids1 = self.get_input_ids(info.caption, tokenizers[0])
+                input_ids2 = self.get_input_ids(info.caption, tokenizers[1])
+                key = hashlib.sha1(input_ids1.numpy().tobytes() + b"/" + input_ids2.numpy().tobytes()).hexdigest()
+                tokenized[info.caption] = (key, input_ids1, input_ids2)
+            key = tokenized[info.caption][0]
+
             if cache_to_disk:
                 te_out_npz = os.path.splitext(info.absolute_path)[0] + TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX
+                if not os.path.exists(te_out_npz):
+                    te_out_npz = os.path.join(os.path.dirname(info.absolute_path), TEXT_ENCODER_OUTPUTS_CACHE_DIR, key + ".npz")
                 info.text_encoder_outputs_npz = te_out_npz
 
                 if not is_main_process:  # store to info only
@@ -896,45 +1164,54 @@ class BaseDataset(torch.utils.data.Dataset):
                 if os.path.exists(te_out_npz):
                     continue
 
-            image_infos_to_cache.append(info)
+            infos_to_cache.setdefault(key, []).append(info)
 
         if cache_to_disk and not is_main_process:  # if cache to disk, don't cache latents in non-main process, set to info only
             return
 
+        print(f"{len(infos_to_cache)} unique captions for {sum(len(infos) for infos in infos_to_cache.values())} images")
+
         # prepare tokenizers and text encoders
         for text_encoder in text_encoders:
             text_encoder.to(device)
             if weight_dtype is not None:
                 text_encoder.to(dtype=weight_dtype)
 
-        # create batch
-        batch = []
-        batches = []
-        for info in image_infos_to_cache:
-            input_ids1 = self.get_input_ids(info.caption, tokenizers[0])
-            input_ids2 = self.get_input_ids(info.caption, tokenizers[1])
-            batch.append((info, input_ids1, input_ids2))
-
-            if len(batch) >= self.batch_size:
-                batches.append(batch)
-                batch = []
-
-        if len(batch) > 0:
-            batches.append(batch)
+        # create batch of unique captions
+        input_ids = {key: (input_ids1, input_ids2) for key, input_ids1, input_ids2 in tokenized.values()}
+        keys = list(infos_to_cache.keys())
+        encode_batch_size = encode_batch_size or self.batch_size
+        batches = [keys[i : i + encode_batch_size] for i in range(0, len(keys), encode_batch_size)]
 
         # iterate batches: call text encoder and cache outputs for memory or disk
         print("caching text encoder outputs...")
         for batch in tqdm(batches):
-            infos, input_ids1, input_ids2 = zip(*batch)
-            input_ids1 = torch.stack(input_ids1, dim=0)
-            input_ids2 = torch.stack(input_ids2, dim=0)
-            cache_batch_text_encoder_outputs(
-                infos, tokenizers, text_encoders, self.max_token_length, cache_to_disk, input_ids1, input_ids2, weight_dtype
+            input_ids1 = torch.stack([input_ids[key][0] for key in batch], dim=0)
+            input_ids2 = torch.stack([input_ids[key][1] for key in batch], dim=0)
+            outputs = encode_text_encoder_outputs(
+                tokenizers, text_encoders, self.max_token_length, input_ids1, input_ids2, weight_dtype
             )
+            for key, hidden_state1, hidden_state2, pool2 in zip(batch, *outputs):
+                infos = infos_to_cache[key]
+                if cache_to_disk:
+                    for npz_path in dict.fromkeys(info.text_encoder_outputs_npz for info in infos):
+                        os.makedirs(os.path.dirname(npz_path), exist_ok=True)
+                        save_text_encoder_outputs_to_disk(npz_path, hidden_state1, hidden_state2, pool2, cache_dtype, compress)
+                    continue
+
+                if cache_dtype is not None:
+                    hidden_state1, hidden_state2, pool2 = [t.to(cache_dtype) for t in (hidden_state1, hidden_state2, pool2)]
+                else:  # don't keep the whole batch alive through the views
+                    hidden_state1, hidden_state2, pool2 = [t.clone() for t in (hidden_state1, hidden_state2, pool2)]
+                for info in infos:
+                    info.text_encoder_outputs1 = hidden_state1
+                    info.text_encoder_outputs2 = hidden_state2
+                    info.text_encoder_pool2 = pool2
 
     def get_image_size(self, image_path):
-        image = Image.open(image_path)
-        return image.size
+        # PIL only parses the header on open, the pixels are never decoded here
+        with Image.open(image_path) as image:
+            return image.size
 
     def load_image_with_face_info(self, subset: BaseSubset, image_path: str):
         img = load_image(image_path)
@@ -1038,6 +1315,13 @@ class BaseDataset(torch.utils.data.Dataset):
                     latents = image_info.latents
                 else:
                     latents = image_info.latents_flipped
+                latents = latents.float()  # may be cached as fp16/bf16
+
+                image = None
+            elif image_info.latents_store is not None:  # cache_latents_to_disk=Trueの場合
+                latents, original_size, crop_ltrb = image_info.latents_store.load(
+                    os.path.basename(image_info.absolute_path), flipped
+                )
 
                 image = None
             elif image_info.latents_npz is not None:  # FineTuningDatasetまたはcache_latents_to_disk=Trueの場合
@@ -1109,9 +1393,9 @@ class BaseDataset(torch.utils.data.Dataset):
             # captionとtext encoder outputを処理する
             caption = image_info.caption  # default
             if image_info.text_encoder_outputs1 is not None:
-                text_encoder_outputs1_list.append(image_info.text_encoder_outputs1)
-                text_encoder_outputs2_list.append(image_info.text_encoder_outputs2)
-                text_encoder_pool2_list.append(image_info.text_encoder_pool2)
+                text_encoder_outputs1_list.append(image_info.text_encoder_outputs1.float())
+                text_encoder_outputs2_list.append(image_info.text_encoder_outputs2.float())
+                text_encoder_pool2_list.append(image_info.text_encoder_pool2.float())
                 captions.append(caption)
             elif image_info.text_encoder_outputs_npz is not None:
                 text_encoder_outputs1, text_encoder_outputs2, text_encoder_pool2 = load_text_encoder_outputs_from_disk(
@@ -1301,7 +1585,7 @@ class DreamBoothDataset(BaseDataset):
             self.bucket_reso_steps = None  # この情報は使われない
             self.bucket_no_upscale = False
 
-        def read_caption(img_path, caption_extension):
+        def read_caption(img_path, caption_extension, index: Optional[DatasetIndex] = None):
             # captionの候補ファイル名を作る
             base_name = os.path.splitext(img_path)[0]
             base_name_face_det = base_name
@@ -1312,16 +1596,28 @@ class DreamBoothDataset(BaseDataset):
 
             caption = None
             for cap_path in cap_paths:
-                if os.path.isfile(cap_path):
-                    with open(cap_path, "rt", encoding="utf-8") as f:
-                        try:
-                            lines = f.readlines()
-                        except UnicodeDecodeError as e:
-                            print(f"illegal char in file (not UTF-8) / ファイルにUTF-8以外の文字があります: {cap_path}")
-                            raise e
-                        assert len(lines) > 0, f"caption file is empty / キャプションファイルが空です: {cap_path}"
-                        caption = lines[0].strip()
-                    break
+                # the index already knows which files exist and holds the captions of unchanged files
+                cap_name = index.name_of(cap_path) if index is not None else None
+                if cap_name is not None:
+                    if not index.has_file(cap_name):
+                        continue
+                    caption = index.caption(cap_name)
+                    if caption is not None:
+                        break
+                elif not os.path.isfile(cap_path):
+                    continue
+
+                with open(cap_path, "rt", encoding="utf-8") as f:
+                    try:
+                        lines = f.readlines()
+                    except UnicodeDecodeError as e:
+                        print(f"illegal char in file (not UTF-8) / ファイルにUTF-8以外の文字があります: {cap_path}")
+                        raise e
+                    assert len(lines) > 0, f"caption file is empty / キャプションファイルが空です: {cap_path}"
+                    caption = lines[0].strip()
+                if cap_name is not None:
+                    index.set_caption(cap_name, caption)
+                break
             return caption
 
         def load_dreambooth_dir(subset: DreamBoothSubset):
@@ -1329,14 +1625,15 @@ class DreamBoothDataset(BaseDataset):
                 print(f"not directory: {subset.image_dir}")
                 return [], []
 
-            img_paths = glob_images(subset.image_dir, "*")
+            index = self.get_dataset_index(subset.image_dir)
+            img_paths = glob_images(subset.image_dir, "*") if index is None else index.image_paths()
             print(f"found directory {subset.image_dir} contains {len(img_paths)} image files")
 
             # 画像ファイルごとにプロンプトを読み込み、もしあればそちらを使う
             captions = []
             missing_captions = []
             for img_path in img_paths:
-                cap_for_img = read_caption(img_path, subset.caption_extension)
+                cap_for_img = read_caption(img_path, subset.caption_extension, index)
                 if cap_for_img is None and subset.class_tokens is None:
                     print(
                         f"neither caption file nor class tokens are found. use empty caption for {img_path} / キャプションファイルもclass tokenも見つかりませんでした。空のキャプションを使用します: {img_path}"
@@ -1815,17 +2112,21 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.enable_XTI(*args, **kwargs)
 
-    def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
+    def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True, **kwargs):
+        kwargs = {**_LATENTS_CACHE_KWARGS, **kwargs}  # the command line options, unless given
         for i, dataset in enumerate(self.datasets):
             print(f"[Dataset {i}]")
-            dataset.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
+            dataset.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process, **kwargs)
 
     def cache_text_encoder_outputs(
-        self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True
+        self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True, **kwargs
     ):
+        kwargs = {**_TEXT_ENCODER_CACHE_KWARGS, **kwargs}  # the command line options, unless given
         for i, dataset in enumerate(self.datasets):
             print(f"[Dataset {i}]")
-            dataset.cache_text_encoder_outputs(tokenizers, text_encoders, device, weight_dtype, cache_to_disk, is_main_process)
+            dataset.cache_text_encoder_outputs(
+                tokenizers, text_encoders, device, weight_dtype, cache_to_disk, is_main_process, **kwargs
+            )
 
     def set_caching_mode(self, caching_mode):
         for dataset in self.datasets:
@@ -1854,6 +2155,209 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
             dataset.disable_token_padding()
 
 
+class LatentStore:
+    """
+    Latents cached to disk for the images of one directory. The arrays are appended to a few large shard files in
+    `LATENTS_STORE_DIR`, with a json index of the shard, offset, shape and dtype of each one and its original_size and
+    crop_ltrb. Checking the cache is an index lookup and loading is a slice of a memory mapped shard, so no file is
+    opened per image.
+
+    Each writer (e.g. a process index) appends to its own shards and index file, readers merge all of them, newest
+    entry first. Setting `stale` makes the next lookup read the index files again, after other writers may have
+    changed them.
+    """
+
+    def __init__(self, directory: str, writer: str = "0") -> None:
+        self.directory = directory
+        self.path = os.path.join(directory, LATENTS_STORE_DIR)
+        self.writer = writer
+        self.entries: Dict[str, dict] = {}
+        self.shards: Dict[str, np.memmap] = {}  # opened lazily, also in dataloader workers
+        self.dirty = False
+        self.stale = False
+        self._file = None
+        self._file_name = None
+        self.load_index()
+
+    def __getstate__(self):
+        # memory maps and the open shard are not sent to dataloader workers, they are reopened there
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        state["_file"] = None
+        state["_file_name"] = None
+        return state
+
+    def load_index(self):
+        self.entries = {}
+        self.shards = {}
+        self.stale = False
+        if not os.path.isdir(self.path):
+            return
+        for file_name in sorted(os.listdir(self.path)):
+            if not (file_name.startswith("index-") and file_name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.path, file_name), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"ignore broken latents index / latentのインデックスが壊れているため無視します: {file_name}, {e}")
+                continue
+            if data.get("version") != LATENTS_STORE_VERSION:
+                continue
+            for name, entry in data["entries"].items():
+                current = self.entries.get(name)
+                if current is None or current["time"] < entry["time"]:
+                    self.entries[name] = entry
+
+    def is_expected(self, name: str, reso, flip_aug: bool) -> bool:
+        expected_latents_size = [reso[1] // 8, reso[0] // 8]  # bucket_resoはWxHなので注意
+
+        if self.stale:
+            self.load_index()
+        entry = self.entries.get(name)
+        if entry is None:
+            return False
+        if entry["latents"]["shape"][1:3] != expected_latents_size:
+            return False
+        if flip_aug:
+            flipped = entry.get("latents_flipped")
+            if flipped is None or flipped["shape"][1:3] != expected_latents_size:
+                return False
+        return True
+
+    def _append(self, tensor, dtype: Optional[torch.dtype] = None) -> dict:
+        if not isinstance(tensor, torch.Tensor):
+            tensor = torch.from_numpy(from_cache_array(np.asarray(tensor)))
+        array = np.ascontiguousarray(to_cache_array(tensor, dtype))
+
+        return self._write(array.tobytes(), list(array.shape), str(array.dtype))
+
+    def _shard_names(self) -> List[str]:
+        prefix = f"shard-{self.writer}-"
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(n for n in os.listdir(self.path) if n.startswith(prefix) and n.endswith(".bin"))
+
+    def _write(self, data: bytes, shape: List[int], dtype: str) -> dict:
+        if self._file is None or self._file.tell() + len(data) > LATENTS_SHARD_SIZE:
+            if self._file is not None:
+                self._file.close()
+            os.makedirs(self.path, exist_ok=True)
+            names = self._shard_names()
+            number = int(names[-1][len(f"shard-{self.writer}-") : -len(".bin")]) + 1 if names else 0
+            self._file_name = f"shard-{self.writer}-{number:05d}.bin"
+            self._file = open(os.path.join(self.path, self._file_name), "ab")
+
+        offset = self._file.tell()
+        self._file.write(data)
+        return {"shard": self._file_name, "offset": offset, "shape": shape, "dtype": dtype}
+
+    def put(self, name: str, latents, original_size, crop_ltrb, flipped_latents=None, dtype: Optional[torch.dtype] = None):
+        entry = {
+            "time": time.time(),
+            "original_size": [int(v) for v in original_size],
+            "crop_ltrb": [int(v) for v in crop_ltrb],
+            "latents": self._append(latents, dtype),
+        }
+        if flipped_latents is not None:
+            entry["latents_flipped"] = self._append(flipped_latents, dtype)
+        self.entries[name] = entry
+        self.dirty = True
+
+    def save(self):
+        if self._file is not None:
+            self._file.flush()
+        if not self.dirty:
+            return
+        obsolete = self.compact()
+        index_path = os.path.join(self.path, f"index-{self.writer}.json")
+        with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": LATENTS_STORE_VERSION, "entries": self.entries}, f)
+        os.replace(index_path + ".tmp", index_path)
+        self.dirty = False
+
+        # only after the index stopped pointing at them
+        for name in obsolete:
+            os.remove(os.path.join(self.path, name))
+
+    def compact(self) -> List[str]:
+        """
+        Re-caching appends the new latents and leaves the old ones in the shards. When less than
+        LATENTS_STORE_COMPACT_RATIO of this writer's shard bytes are still referenced, the referenced latents are copied
+        to new shards. Returns the names of the old shards, to be removed once the index is saved.
+        """
+        names = self._shard_names()
+        shard_names = set(names)
+        refs = [entry[key] for entry in self.entries.values() for key in ("latents", "latents_flipped") if key in entry]
+        refs = [ref for ref in refs if ref["shard"] in shard_names]
+        total = sum(os.path.getsize(os.path.join(self.path, name)) for name in names)
+        live = sum(self._nbytes(ref) for ref in refs)
+        if total == 0 or live >= total * LATENTS_STORE_COMPACT_RATIO:
+            return []
+
+        print(f"compacting latents / latentのファイルを整理します: {self.path}, {live / 2**20:.0f}/{total / 2**20:.0f} MiB in use")
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        now = time.time()
+        for entry in self.entries.values():
+            for key in ("latents", "latents_flipped"):
+                ref = entry.get(key)
+                if ref is not None and ref["shard"] in shard_names:
+                    entry[key] = self._write(self._bytes(ref).tobytes(), ref["shape"], ref["dtype"])
+                    entry["time"] = now  # newer than the copies other writers' indexes may hold
+        if self._file is not None:
+            self._file.flush()
+        self.shards = {}  # drop the maps of the old shards
+        return names
+
+    @staticmethod
+    def _nbytes(ref: dict) -> int:
+        return int(np.prod(ref["shape"])) * np.dtype(ref["dtype"]).itemsize
+
+    def _bytes(self, ref: dict) -> np.ndarray:
+        nbytes = self._nbytes(ref)
+        shard = self.shards.get(ref["shard"])
+        if shard is None or ref["offset"] + nbytes > len(shard):  # not opened yet or appended since
+            # copy-on-write, so the slices are writable without copying the data
+            shard = np.memmap(os.path.join(self.path, ref["shard"]), dtype=np.uint8, mode="c")
+            self.shards[ref["shard"]] = shard
+        return shard[ref["offset"] : ref["offset"] + nbytes]
+
+    def _read(self, ref: dict) -> torch.Tensor:
+        array = self._bytes(ref).view(np.dtype(ref["dtype"])).reshape(ref["shape"])
+        return torch.from_numpy(from_cache_array(array))  # float32 latents are not copied
+
+    # 戻り値は、latents_tensor, (original_size width, original_size height), (crop left, crop top, crop right, crop bottom)
+    def load(self, name: str, flipped: bool = False) -> Tuple[torch.Tensor, List[int], List[int]]:
+        if self.stale:
+            self.load_index()
+        entry = self.entries.get(name)
+        if entry is None:  # written by another process after this copy of the index was read
+            self.load_index()
+            entry = self.entries[name]
+        ref = entry["latents_flipped"] if flipped else entry["latents"]
+        return self._read(ref), entry["original_size"], entry["crop_ltrb"]
+
+
+def to_cache_array(tensor: torch.Tensor, dtype: Optional[torch.dtype] = None) -> np.ndarray:
+    """
+    Converts a tensor to the array stored in the latents and text encoder output caches, float32 when dtype is None.
+    numpy has no bfloat16, so bf16 is stored as its raw bits in an uint16 array.
+    """
+    tensor = tensor.detach().cpu()
+    if dtype == torch.bfloat16:
+        return tensor.to(torch.bfloat16).view(torch.int16).numpy().view(np.uint16)
+    return tensor.to(dtype or torch.float32).numpy()
+
+
+def from_cache_array(array: np.ndarray) -> np.ndarray:
+    """Upcasts a cached array written by to_cache_array to float32."""
+    if array.dtype == np.uint16:  # bf16 bits are the upper half of the float32 bits
+        return (array.astype(np.uint32) << 16).view(np.float32)
+    return array.astype(np.float32, copy=False)
+
+
 def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool):
     expected_latents_size = (reso[1] // 8, reso[0] // 8)  # bucket_resoはWxHなので注意
 
@@ -1883,20 +2387,22 @@ def load_latents_from_disk(
     if "latents" not in npz:
         raise ValueError(f"error: npz is old format. please re-generate {npz_path}")
 
-    latents = npz["latents"]
+    latents = from_cache_array(npz["latents"])
     original_size = npz["original_size"].tolist()
     crop_ltrb = npz["crop_ltrb"].tolist()
-    flipped_latents = npz["latents_flipped"] if "latents_flipped" in npz else None
+    flipped_latents = from_cache_array(npz["latents_flipped"]) if "latents_flipped" in npz else None
     return latents, original_size, crop_ltrb, flipped_latents
 
 
-def save_latents_to_disk(npz_path, latents_tensor, original_size, crop_ltrb, flipped_latents_tensor=None):
+def save_latents_to_disk(
+    npz_path, latents_tensor, original_size, crop_ltrb, flipped_latents_tensor=None, cache_dtype=None, compress=False
+):
     kwargs = {}
     if flipped_latents_tensor is not None:
-        kwargs["latents_flipped"] = flipped_latents_tensor.float().cpu().numpy()
-    np.savez(
+        kwargs["latents_flipped"] = to_cache_array(flipped_latents_tensor, cache_dtype)
+    (np.savez_compressed if compress else np.savez)(
         npz_path,
-        latents=latents_tensor.float().cpu().numpy(),
+        latents=to_cache_array(latents_tensor, cache_dtype),
         original_size=np.array(original_size),
         crop_ltrb=np.array(crop_ltrb),
         **kwargs,
@@ -2115,31 +2621,71 @@ def trim_and_resize_if_required(
     return image, original_size, crop_ltrb
 
 
+class LatentCachingDataset(torch.utils.data.Dataset):
+    """
+    Loads and crops the images of the latent caching batches, so dataloader workers can prepare the next batches while
+    the vae encodes. `random_crops` is the random_crop setting of the subset of each batch. Items are
+    (batch index, image tensors, [(original_size, crop_ltrb)]).
+    """
+
+    def __init__(self, batches: List[List[ImageInfo]], random_crops: Sequence[bool]):
+        self.batches = batches
+        self.random_crops = random_crops
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        images = []
+        sizes = []
+        for info in self.batches[index]:
+            image = load_image(info.absolute_path) if info.image is None else np.array(info.image, np.uint8)
+            # TODO 画像のメタデータが壊れていて、メタデータから割り当てたbucketと実際の画像サイズが一致しない場合があるのでチェック追加要
+            image, original_size, crop_ltrb = trim_and_resize_if_required(
+                self.random_crops[index], image, info.bucket_reso, info.resized_size
+            )
+            images.append(IMAGE_TRANSFORMS(image))
+            sizes.append((original_size, crop_ltrb))
+        return index, torch.stack(images, dim=0), sizes
+
+
 def cache_batch_latents(
     vae: AutoencoderKL, cache_to_disk: bool, image_infos: List[ImageInfo], flip_aug: bool, random_crop: bool
 ) -> None:
     r"""
-    requires image_infos to have: absolute_path, bucket_reso, resized_size, latents_npz
+    requires image_infos to have: absolute_path, bucket_reso, resized_size, latents_npz or latents_store
     optionally requires image_infos to have: image
-    if cache_to_disk is True, set info.latents_npz
+    if cache_to_disk is True, set info.latents_npz or info.latents_store (the store is saved by the caller)
         flipped latents is also saved if flip_aug is True
     if cache_to_disk is False, set info.latents
         latents_flipped is also set if flip_aug is True
     latents_original_size and latents_crop_ltrb are also set
     """
-    images = []
-    for info in image_infos:
-        image = load_image(info.absolute_path) if info.image is None else np.array(info.image, np.uint8)
-        # TODO 画像のメタデータが壊れていて、メタデータから割り当てたbucketと実際の画像サイズが一致しない場合があるのでチェック追加要
-        image, original_size, crop_ltrb = trim_and_resize_if_required(random_crop, image, info.bucket_reso, info.resized_size)
-        image = IMAGE_TRANSFORMS(image)
-        images.append(image)
-
+    _, img_tensors, sizes = LatentCachingDataset([image_infos], [random_crop])[0]
+    for info, (original_size, crop_ltrb) in zip(image_infos, sizes):
         info.latents_original_size = original_size
         info.latents_crop_ltrb = crop_ltrb
 
-    img_tensors = torch.stack(images, dim=0)
-    img_tensors = img_tensors.to(device=vae.device, dtype=vae.dtype)
+    encode_batch_latents(vae, cache_to_disk, image_infos, img_tensors, flip_aug, empty_cache=True)
+
+
+def encode_batch_latents(
+    vae: AutoencoderKL,
+    cache_to_disk: bool,
+    image_infos: List[ImageInfo],
+    img_tensors: torch.Tensor,
+    flip_aug: bool,
+    writer: Optional[concurrent.futures.Executor] = None,
+    empty_cache: bool = False,
+    cache_dtype: Optional[torch.dtype] = None,
+    compress: bool = False,
+) -> concurrent.futures.Future:
+    """
+    Encodes the prepared images of `image_infos` and caches the latents like cache_batch_latents. Disk writes are
+    submitted to `writer` when given, the returned future is done when they are. The latents are cached as
+    `cache_dtype`, see to_cache_array.
+    """
+    img_tensors = img_tensors.to(device=vae.device, dtype=vae.dtype, non_blocking=True)
 
     with torch.no_grad():
         latents = vae.encode(img_tensors).latent_dist.sample().to("cpu")
@@ -2156,21 +2702,77 @@ def cache_batch_latents(
         if torch.isnan(latents).any() or (flipped_latent is not None and torch.isnan(flipped_latent).any()):
             raise RuntimeError(f"NaN detected in latents: {info.absolute_path}")
 
-        if cache_to_disk:
-            save_latents_to_disk(info.latents_npz, latent, info.latents_original_size, info.latents_crop_ltrb, flipped_latent)
-        else:
-            info.latents = latent
-            if flip_aug:
-                info.latents_flipped = flipped_latent
+    def save():
+        for info, latent, flipped_latent in zip(image_infos, latents, flipped_latents):
+            if info.latents_store is not None:
+                info.latents_store.put(
+                    os.path.basename(info.absolute_path),
+                    latent,
+                    info.latents_original_size,
+                    info.latents_crop_ltrb,
+                    flipped_latent,
+                    cache_dtype,
+                )
+            elif cache_to_disk:
+                save_latents_to_disk(
+                    info.latents_npz,
+                    latent,
+                    info.latents_original_size,
+                    info.latents_crop_ltrb,
+                    flipped_latent,
+                    cache_dtype,
+                    compress,
+                )
+            else:
+                info.latents = latent if cache_dtype is None else latent.to(cache_dtype)
+                if flip_aug:
+                    info.latents_flipped = flipped_latent if cache_dtype is None else flipped_latent.to(cache_dtype)
+
+    if writer is not None and cache_to_disk:
+        future = writer.submit(save)
+    else:
+        future = concurrent.futures.Future()
+        save()
+        future.set_result(None)
 
-    # FIXME this slows down caching a lot, specify this as an option
-    if torch.cuda.is_available():
+    if empty_cache and torch.cuda.is_available():
         torch.cuda.empty_cache()
 
+    return future
+
 
 def cache_batch_text_encoder_outputs(
-    image_infos, tokenizers, text_encoders, max_token_length, cache_to_disk, input_ids1, input_ids2, dtype
+    image_infos,
+    tokenizers,
+    text_encoders,
+    max_token_length,
+    cache_to_disk,
+    input_ids1,
+    input_ids2,
+    dtype,
+    cache_dtype=None,
+    compress=False,
 ):
+    b_hidden_state1, b_hidden_state2, b_pool2 = encode_text_encoder_outputs(
+        tokenizers, text_encoders, max_token_length, input_ids1, input_ids2, dtype
+    )
+
+    for info, hidden_state1, hidden_state2, pool2 in zip(image_infos, b_hidden_state1, b_hidden_state2, b_pool2):
+        if cache_to_disk:
+            save_text_encoder_outputs_to_disk(
+                info.text_encoder_outputs_npz, hidden_state1, hidden_state2, pool2, cache_dtype, compress
+            )
+        elif cache_dtype is not None:
+            info.text_encoder_outputs1 = hidden_state1.to(cache_dtype)
+            info.text_encoder_outputs2 = hidden_state2.to(cache_dtype)
+            info.text_encoder_pool2 = pool2.to(cache_dtype)
+        else:
+            info.text_encoder_outputs1 = hidden_state1
+            info.text_encoder_outputs2 = hidden_state2
+            info.text_encoder_pool2 = pool2
+
+
+def encode_text_encoder_outputs(tokenizers, text_encoders, max_token_length, input_ids1, input_ids2, dtype):
     input_ids1 = input_ids1.to(text_encoders[0].device)
     input_ids2 = input_ids2.to(text_encoders[1].device)
 
@@ -2191,29 +2793,23 @@ def cache_batch_text_encoder_outputs(
         b_hidden_state2 = b_hidden_state2.detach().to("cpu")  # b,n*75+2,1280
         b_pool2 = b_pool2.detach().to("cpu")  # b,1280
 
-    for info, hidden_state1, hidden_state2, pool2 in zip(image_infos, b_hidden_state1, b_hidden_state2, b_pool2):
-        if cache_to_disk:
-            save_text_encoder_outputs_to_disk(info.text_encoder_outputs_npz, hidden_state1, hidden_state2, pool2)
-        else:
-            info.text_encoder_outputs1 = hidden_state1
-            info.text_encoder_outputs2 = hidden_state2
-            info.text_encoder_pool2 = pool2
+    return b_hidden_state1, b_hidden_state2, b_pool2
 
 
-def save_text_encoder_outputs_to_disk(npz_path, hidden_state1, hidden_state2, pool2):
-    np.savez(
+def save_text_encoder_outputs_to_disk(npz_path, hidden_state1, hidden_state2, pool2, cache_dtype=None, compress=False):
+    (np.savez_compressed if compress else np.savez)(
         npz_path,
-        hidden_state1=hidden_state1.cpu().float().numpy(),
-        hidden_state2=hidden_state2.cpu().float().numpy(),
-        pool2=pool2.cpu().float().numpy(),
+        hidden_state1=to_cache_array(hidden_state1, cache_dtype),
+        hidden_state2=to_cache_array(hidden_state2, cache_dtype),
+        pool2=to_cache_array(pool2, cache_dtype),
     )
 
 
 def load_text_encoder_outputs_from_disk(npz_path):
     with np.load(npz_path) as f:
-        hidden_state1 = torch.from_numpy(f["hidden_state1"])
-        hidden_state2 = torch.from_numpy(f["hidden_state2"]) if "hidden_state2" in f else None
-        pool2 = torch.from_numpy(f["pool2"]) if "pool2" in f else None
+        hidden_state1 = torch.from_numpy(from_cache_array(f["hidden_state1"]))
+        hidden_state2 = torch.from_numpy(from_cache_array(f["hidden_state2"])) if "hidden_state2" in f else None
+        pool2 = torch.from_numpy(from_cache_array(f["pool2"])) if "pool2" in f else None
     return hidden_state1, hidden_state2, pool2
 
 
@@ -2918,6 +3514,28 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
         ],
         help=f"sampler (scheduler) type for sample images / サンプル出力時のサンプラー（スケジューラ）の種類",
     )
+    parser.add_argument(
+        "--sample_batch_size",
+        type=int,
+        default=1,
+        help="generate sample prompts with the same size, steps and scale in batches of this size / サイズ、ステップ数、スケールが同じサンプルプロンプトをこのバッチサイズでまとめて生成する",
+    )
+    parser.add_argument(
+        "--sample_async",
+        action="store_true",
+        help="generate sample images in the background on a snapshot of the weights, without blocking training / 重みのスナップショットを使い、学習を止めずにバックグラウンドでサンプル画像を生成する",
+    )
+    parser.add_argument(
+        "--sample_empty_cache",
+        action="store_true",
+        help="empty the cuda cache after generating sample images (slow) / サンプル画像生成後にcudaのキャッシュを解放する（遅い）",
+    )
+    parser.add_argument(
+        "--sample_device",
+        type=str,
+        default=None,
+        help="device for --sample_async, e.g. cuda:1 or cpu (default: training device) / --sample_async で使うデバイス（例: cuda:1, cpu、省略時は学習デバイス）",
+    )
 
     parser.add_argument(
         "--config_file",
@@ -3069,6 +3687,37 @@ def add_dataset_arguments(
         action="store_true",
         help="cache latents to disk to reduce VRAM usage (augmentations must be disabled) / VRAM削減のためにlatentをディスクにcacheする（augmentationは使用不可）",
     )
+    parser.add_argument(
+        "--latents_cache_num_workers",
+        type=int,
+        default=2,
+        help="dataloader workers loading images while caching latents / latentのキャッシュ時に画像を読み込むDataLoaderのワーカー数",
+    )
+    parser.add_argument(
+        "--latents_cache_empty_cache",
+        action="store_true",
+        help="empty the cuda cache after every batch while caching latents (slow) / latentのキャッシュ時にバッチごとにcudaのキャッシュを解放する（遅い）",
+    )
+    parser.add_argument(
+        "--cache_dtype",
+        type=str,
+        default=None,
+        choices=[None, "float", "fp16", "bf16"],
+        help="precision of cached latents and text encoder outputs, upcast to float when loaded / "
+        + "キャッシュするlatentとtext encoderの出力の精度、読み込み時にfloatに戻す",
+    )
+    parser.add_argument(
+        "--cache_compress",
+        action="store_true",
+        help="compress cached npz files (latents and text encoder outputs) / キャッシュするnpzファイル（latentとtext encoderの出力）を圧縮する",
+    )
+    parser.add_argument(
+        "--latents_cache_format",
+        type=str,
+        default="store",
+        choices=["store", "npz"],
+        help="format of latents cached to disk: shard files with an index per image directory, or an npz per image / ディスクにキャッシュするlatentの形式：画像ディレクトリごとのシャードファイルとインデックス、または画像ごとのnpz",
+    )
     parser.add_argument(
         "--enable_bucket", action="store_true", help="enable buckets for multi aspect ratio training / 複数解像度学習のためのbucketを有効にする"
     )
@@ -3612,6 +4261,12 @@ def get_scheduler_fix(args, optimizer: Optimizer, num_processes: int):
     return schedule_func(optimizer, num_warmup_steps=num_warmup_steps, num_training_steps=num_training_steps, **lr_scheduler_kwargs)
 
 
+# caching options of the command line, set by prepare_dataset_args. The training scripts do not pass them, so
+# DatasetGroup.cache_latents and cache_text_encoder_outputs use these unless they are given
+_LATENTS_CACHE_KWARGS = {}
+_TEXT_ENCODER_CACHE_KWARGS = {}
+
+
 def prepare_dataset_args(args: argparse.Namespace, support_metadata: bool):
     # backward compatibility
     if args.caption_extention is not None:
@@ -3641,6 +4296,22 @@ def prepare_dataset_args(args: argparse.Namespace, support_metadata: bool):
                 f"latents in npz is ignored when color_aug or random_crop is True / color_augまたはrandom_cropを有効にした場合、npzファイルのlatentsは無視されます"
             )
 
+    cache_dtype = prepare_cache_dtype(args)
+    _LATENTS_CACHE_KWARGS.clear()
+    _LATENTS_CACHE_KWARGS.update(
+        cache_format=args.latents_cache_format,
+        num_workers=args.latents_cache_num_workers,
+        empty_cache=args.latents_cache_empty_cache,
+        cache_dtype=cache_dtype,
+        compress=args.cache_compress,
+    )
+    _TEXT_ENCODER_CACHE_KWARGS.clear()
+    _TEXT_ENCODER_CACHE_KWARGS.update(
+        cache_dtype=cache_dtype,
+        compress=args.cache_compress,
+        encode_batch_size=getattr(args, "text_encoder_cache_batch_size", None),  # SDXLのみ
+    )
+
 
 def load_tokenizer(args: argparse.Namespace):
     print("prepare tokenizer")
@@ -3724,6 +4395,17 @@ def prepare_dtype(args: argparse.Namespace):
     return weight_dtype, save_dtype
 
 
+def prepare_cache_dtype(args: argparse.Namespace):
+    cache_dtype = None
+    if args.cache_dtype == "fp16":
+        cache_dtype = torch.float16
+    elif args.cache_dtype == "bf16":
+        cache_dtype = torch.bfloat16
+    elif args.cache_dtype == "float":
+        cache_dtype = torch.float32
+    return cache_dtype
+
+
 def _load_target_model(args: argparse.Namespace, weight_dtype, device="cpu", unet_use_linear_projection_in_v2=False):
     name_or_path = args.pretrained_model_name_or_path
     name_or_path = os.readlink(name_or_path) if os.path.islink(name_or_path) else name_or_path
@@ -4315,6 +4997,10 @@ def sample_images_common(
 ):
     """
     StableDiffusionLongPromptWeightingPipelineの改造版を使うようにしたので、clip skipおよびプロンプトの重みづけに対応した
+
+    The pipeline is built once and reused by later calls. Prompts sharing size, steps and scale are generated
+    together in batches of `args.sample_batch_size`. With `args.sample_async`, the models are snapshotted to
+    `args.sample_device` and the samples are generated in a background thread while training continues.
     """
     if args.sample_every_n_steps is None and args.sample_every_n_epochs is None:
         return
@@ -4331,9 +5017,6 @@ def sample_images_common(
         print(f"No prompt file / プロンプトファイルがありません: {args.sample_prompts}")
         return
 
-    org_vae_device = vae.device  # CPUにいるはず
-    vae.to(device)
-
     # read prompts
 
     # with open(args.sample_prompts, "rt", encoding="utf-8") as f:
@@ -4351,6 +5034,81 @@ def sample_images_common(
         with open(args.sample_prompts, "r", encoding="utf-8") as f:
             prompts = json.load(f)
 
+    prompts = [parse_sample_prompt(prompt, prompt_replacement) for prompt in prompts]
+
+    save_dir = args.output_dir + "/sample"
+    os.makedirs(save_dir, exist_ok=True)
+
+    sample_async = getattr(args, "sample_async", False)
+    if sample_async:
+        if not accelerator.is_main_process:
+            return
+
+        global _SAMPLE_EXECUTOR, _SAMPLE_FUTURE
+        if _SAMPLE_FUTURE is not None and not _SAMPLE_FUTURE.done():
+            print("waiting for previous sample images / 前回のサンプル画像生成を待機しています")
+        wait_for_sample_images()
+
+        sample_device = torch.device(getattr(args, "sample_device", None) or device)
+        vae, text_encoder, unet, controlnet = snapshot_sample_models(sample_device, vae, text_encoder, unet, controlnet)
+        pipeline = get_sample_pipeline(pipe_class, args, sample_device, vae, tokenizer, text_encoder, unet)
+
+        if _SAMPLE_EXECUTOR is None:
+            _SAMPLE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sample-images")
+            atexit.register(wait_for_sample_images)  # the last samples are written even if training does not wait
+        _SAMPLE_FUTURE = _SAMPLE_EXECUTOR.submit(
+            generate_sample_images, pipeline, accelerator, args, epoch, steps, prompts, save_dir, controlnet, True
+        )
+        _SAMPLE_FUTURE.add_done_callback(_report_sample_images)
+        return
+
+    org_vae_device = vae.device  # CPUにいるはず
+    vae.to(device)
+
+    pipeline = get_sample_pipeline(pipe_class, args, device, vae, tokenizer, text_encoder, unet)
+
+    rng_state = torch.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+
+    if accelerator.is_main_process:
+        generate_sample_images(pipeline, accelerator, args, epoch, steps, prompts, save_dir, controlnet)
+
+    vae.to(org_vae_device)
+    # the pipeline is kept for the next call, clearing the cache reduces vram usage but slows down training
+    if getattr(args, "sample_empty_cache", False) and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    torch.set_rng_state(rng_state)
+    if cuda_rng_state is not None:
+        torch.cuda.set_rng_state(cuda_rng_state)
+
+
+# pipelines built by sample_images_common, reused across calls
+_SAMPLE_PIPELINES = {}
+# models snapshotted for asynchronous sampling, keyed by the id of the trained unet and the device
+_SAMPLE_SNAPSHOTS = {}
+_SAMPLE_EXECUTOR = None
+_SAMPLE_FUTURE = None
+
+
+def wait_for_sample_images():
+    """
+    Waits until the samples being generated in the background, if any, are written. Also called at exit.
+    Failures are reported by _report_sample_images and do not stop training.
+    """
+    if _SAMPLE_FUTURE is not None:
+        concurrent.futures.wait([_SAMPLE_FUTURE])
+
+
+def _report_sample_images(future: concurrent.futures.Future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        print(f"generating sample images failed / サンプル画像の生成に失敗しました: {error!r}")
+
+
+def get_sample_scheduler(args: argparse.Namespace):
     # schedulerを用意する
     sched_init_args = {}
     if args.sample_sampler == "ddim":
@@ -4395,159 +5153,280 @@ def sample_images_common(
         # print("set clip_sample to True")
         scheduler.config.clip_sample = True
 
-    pipeline = pipe_class(
-        text_encoder=text_encoder,
-        vae=vae,
-        unet=unet,
-        tokenizer=tokenizer,
-        scheduler=scheduler,
-        safety_checker=None,
-        feature_extractor=None,
-        requires_safety_checker=False,
-        clip_skip=args.clip_skip,
-    )
-    pipeline.to(device)
+    return scheduler
 
-    save_dir = args.output_dir + "/sample"
-    os.makedirs(save_dir, exist_ok=True)
 
-    rng_state = torch.get_rng_state()
-    cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+def get_sample_pipeline(pipe_class, args: argparse.Namespace, device, vae, tokenizer, text_encoder, unet):
+    """
+    Returns the sampling pipeline for these models, building it on the first call. The scheduler is replaced with a
+    fresh one every time, since it keeps state between steps.
+    """
+    text_encoders = text_encoder if isinstance(text_encoder, (list, tuple)) else [text_encoder]
+    key = (pipe_class, id(vae), id(unet), tuple(id(te) for te in text_encoders), args.clip_skip, str(device))
+    pipeline = _SAMPLE_PIPELINES.get(key)
+    if pipeline is None:
+        pipeline = pipe_class(
+            text_encoder=text_encoder,
+            vae=vae,
+            unet=unet,
+            tokenizer=tokenizer,
+            scheduler=get_sample_scheduler(args),
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+            clip_skip=args.clip_skip,
+        )
+        pipeline.to(device)
+        _SAMPLE_PIPELINES[key] = pipeline
+    else:
+        pipeline.scheduler = get_sample_scheduler(args)
+    return pipeline
 
-    with torch.no_grad():
-        # with accelerator.autocast():
-        for i, prompt in enumerate(prompts):
-            if not accelerator.is_main_process:
-                continue
 
-            if isinstance(prompt, dict):
-                negative_prompt = prompt.get("negative_prompt")
-                sample_steps = prompt.get("sample_steps", 30)
-                width = prompt.get("width", 512)
-                height = prompt.get("height", 512)
-                scale = prompt.get("scale", 7.5)
-                seed = prompt.get("seed")
-                controlnet_image = prompt.get("controlnet_image")
-                prompt = prompt.get("prompt")
+def snapshot_sample_models(device, vae, text_encoder, unet, controlnet=None):
+    """
+    Copies the current weights of the models to `device` for asynchronous sampling. The first call deep copies the
+    models together, so networks patched into their forward (LoRA etc.) are carried over with them, and needs room
+    for a second copy on the training device for a moment. Later calls only copy the weights into the snapshot.
+    Snapshots on the cpu are kept in float32.
+    """
+    device = torch.device(device)
+    models = (vae, text_encoder, unet, controlnet)
+    key = (id(unet), str(device))
+
+    entry = _SAMPLE_SNAPSHOTS.get(key)
+    if entry is None:
+        memo = {}
+        with torch.no_grad():
+            copies = copy.deepcopy(models, memo)
+
+        # every tensor reachable from the models, whether it belongs to them or to a network patched into them
+        pairs = []
+        for original in memo.get(id(memo), []):
+            if isinstance(original, torch.Tensor):
+                copied = memo[id(original)]
+                dtype = torch.float32 if device.type == "cpu" and copied.is_floating_point() else copied.dtype
+                copied.data = copied.data.to(device, dtype=dtype)
+                pairs.append((original, copied))
+
+        for model in copies:
+            for m in model if isinstance(model, (list, tuple)) else [model]:
+                if m is not None:
+                    m.eval().requires_grad_(False)
+
+        entry = _SAMPLE_SNAPSHOTS[key] = (copies, pairs)
+    else:
+        with torch.no_grad():
+            for original, copied in entry[1]:
+                copied.copy_(original, non_blocking=True)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return entry[0]
+
+
+def parse_sample_prompt(prompt, prompt_replacement=None) -> dict:
+    """
+    Parses a line of the prompt file (`prompt --w 512 --h 512 --d 1 --s 30 --l 7.5 --n negative --cn image`) or a
+    toml/json prompt entry into a dict of generation settings.
+    """
+    if isinstance(prompt, dict):
+        negative_prompt = prompt.get("negative_prompt")
+        sample_steps = prompt.get("sample_steps", 30)
+        width = prompt.get("width", 512)
+        height = prompt.get("height", 512)
+        scale = prompt.get("scale", 7.5)
+        seed = prompt.get("seed")
+        controlnet_image = prompt.get("controlnet_image")
+        prompt = prompt.get("prompt")
+    else:
+        # prompt = prompt.strip()
+        # if len(prompt) == 0 or prompt[0] == "#":
+        #     continue
+
+        # subset of gen_img_diffusers
+        prompt_args = prompt.split(" --")
+        prompt = prompt_args[0]
+        negative_prompt = None
+        sample_steps = 30
+        width = height = 512
+        scale = 7.5
+        seed = None
+        controlnet_image = None
+        for parg in prompt_args:
+            try:
+                m = re.match(r"w (\d+)", parg, re.IGNORECASE)
+                if m:
+                    width = int(m.group(1))
+                    continue
+
+                m = re.match(r"h (\d+)", parg, re.IGNORECASE)
+                if m:
+                    height = int(m.group(1))
+                    continue
+
+                m = re.match(r"d (\d+)", parg, re.IGNORECASE)
+                if m:
+                    seed = int(m.group(1))
+                    continue
+
+                m = re.match(r"s (\d+)", parg, re.IGNORECASE)
+                if m:  # steps
+                    sample_steps = max(1, min(1000, int(m.group(1))))
+                    continue
+
+                m = re.match(r"l ([\d\.]+)", parg, re.IGNORECASE)
+                if m:  # scale
+                    scale = float(m.group(1))
+                    continue
+
+                m = re.match(r"n (.+)", parg, re.IGNORECASE)
+                if m:  # negative prompt
+                    negative_prompt = m.group(1)
+                    continue
+
+                m = re.match(r"cn (.+)", parg, re.IGNORECASE)
+                if m:  # negative prompt
+                    controlnet_image = m.group(1)
+                    continue
+
+            except ValueError as ex:
+                print(f"Exception in parsing / 解析エラー: {parg}")
+                print(ex)
+
+    if prompt_replacement is not None:
+        prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
+        if negative_prompt is not None:
+            negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
+
+    return {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "sample_steps": sample_steps,
+        "width": max(64, width - width % 8),  # round to divisible by 8
+        "height": max(64, height - height % 8),  # round to divisible by 8
+        "scale": scale,
+        "seed": seed,
+        "controlnet_image": controlnet_image,
+    }
+
+
+def generate_sample_images(
+    pipeline, accelerator, args: argparse.Namespace, epoch, steps, prompts, save_dir, controlnet=None, use_generator=False
+):
+    """
+    Generates and saves the parsed `prompts`. Prompts with the same size, steps and scale (and no controlnet image) are
+    run together, up to `args.sample_batch_size` at a time.
+
+    A prompt run on its own is seeded through the global torch rng, which sample_images_common restores afterwards.
+    Prompts in a batch, and all prompts with `use_generator` (asynchronous sampling, which must not touch the global
+    rng), draw their initial latents from a generator of their own seed instead; the scheduler noise of a batch comes
+    from the generator of its first seeded prompt, so a seeded prompt only reproduces the same image in a batch of the
+    same prompts. With `use_generator`, unseeded prompts get a random seed from os.urandom.
+    """
+    batch_size = max(1, getattr(args, "sample_batch_size", 1) or 1)
+    device = torch.device(pipeline.device)
+
+    batches = []
+    groups = {}
+    for i, p in enumerate(prompts):
+        if p["controlnet_image"] is not None or batch_size == 1:
+            batches.append([i])
+            continue
+        key = (p["width"], p["height"], p["sample_steps"], p["scale"])
+        group = groups.get(key)
+        if group is None or len(group) >= batch_size:
+            group = groups[key] = []
+            batches.append(group)
+        group.append(i)
+
+    rand_device = "cpu" if device.type == "mps" else device
+    latent_channels = pipeline.unet.in_channels
+    dtype = pipeline.unet.dtype
+
+    with torch.no_grad():
+        for batch in batches:
+            first = prompts[batch[0]]
+            width, height = first["width"], first["height"]
+
+            latents = None
+            generator = None
+            if len(batch) == 1 and not use_generator:
+                # the pipeline draws the latents from the global rng
+                seed = first["seed"]
+                if seed is not None:
+                    torch.manual_seed(seed)
+                    torch.cuda.manual_seed(seed)
             else:
-                # prompt = prompt.strip()
-                # if len(prompt) == 0 or prompt[0] == "#":
-                #     continue
-
-                # subset of gen_img_diffusers
-                prompt_args = prompt.split(" --")
-                prompt = prompt_args[0]
-                negative_prompt = None
-                sample_steps = 30
-                width = height = 512
-                scale = 7.5
-                seed = None
-                controlnet_image = None
-                for parg in prompt_args:
-                    try:
-                        m = re.match(r"w (\d+)", parg, re.IGNORECASE)
-                        if m:
-                            width = int(m.group(1))
-                            continue
-
-                        m = re.match(r"h (\d+)", parg, re.IGNORECASE)
-                        if m:
-                            height = int(m.group(1))
-                            continue
-
-                        m = re.match(r"d (\d+)", parg, re.IGNORECASE)
-                        if m:
-                            seed = int(m.group(1))
-                            continue
-
-                        m = re.match(r"s (\d+)", parg, re.IGNORECASE)
-                        if m:  # steps
-                            sample_steps = max(1, min(1000, int(m.group(1))))
-                            continue
-
-                        m = re.match(r"l ([\d\.]+)", parg, re.IGNORECASE)
-                        if m:  # scale
-                            scale = float(m.group(1))
-                            continue
-
-                        m = re.match(r"n (.+)", parg, re.IGNORECASE)
-                        if m:  # negative prompt
-                            negative_prompt = m.group(1)
-                            continue
-
-                        m = re.match(r"cn (.+)", parg, re.IGNORECASE)
-                        if m:  # negative prompt
-                            controlnet_image = m.group(1)
-                            continue
-
-                    except ValueError as ex:
-                        print(f"Exception in parsing / 解析エラー: {parg}")
-                        print(ex)
-
-            if seed is not None:
-                torch.manual_seed(seed)
-                torch.cuda.manual_seed(seed)
-
-            if prompt_replacement is not None:
-                prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
-                if negative_prompt is not None:
-                    negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
+                latents = []
+                for i in batch:
+                    seed = prompts[i]["seed"]
+                    if seed is None and use_generator:
+                        seed = int.from_bytes(os.urandom(4), "little")
+
+                    if seed is not None:
+                        prompt_generator = torch.Generator(rand_device).manual_seed(seed)
+                        if generator is None:
+                            # also drives the scheduler noise of the batch
+                            generator = prompt_generator
+                    else:
+                        prompt_generator = None
+                    shape = (1, latent_channels, height // pipeline.vae_scale_factor, width // pipeline.vae_scale_factor)
+                    latents.append(torch.randn(shape, generator=prompt_generator, device=rand_device, dtype=dtype))
+                latents = torch.cat(latents).to(device)
 
+            controlnet_image = first["controlnet_image"]
             if controlnet_image is not None:
                 controlnet_image = Image.open(controlnet_image).convert("RGB")
                 controlnet_image = controlnet_image.resize((width, height), Image.LANCZOS)
 
-            height = max(64, height - height % 8)  # round to divisible by 8
-            width = max(64, width - width % 8)  # round to divisible by 8
-            print(f"prompt: {prompt}")
-            print(f"negative_prompt: {negative_prompt}")
-            print(f"height: {height}")
-            print(f"width: {width}")
-            print(f"sample_steps: {sample_steps}")
-            print(f"scale: {scale}")
+            for i in batch:
+                p = prompts[i]
+                print(f"prompt: {p['prompt']}")
+                print(f"negative_prompt: {p['negative_prompt']}")
+                print(f"height: {height}")
+                print(f"width: {width}")
+                print(f"sample_steps: {p['sample_steps']}")
+                print(f"scale: {p['scale']}")
+
             with accelerator.autocast():
                 latents = pipeline(
-                    prompt=prompt,
+                    prompt=[prompts[i]["prompt"] for i in batch],
                     height=height,
                     width=width,
-                    num_inference_steps=sample_steps,
-                    guidance_scale=scale,
-                    negative_prompt=negative_prompt,
+                    num_inference_steps=first["sample_steps"],
+                    guidance_scale=first["scale"],
+                    negative_prompt=[prompts[i]["negative_prompt"] or "" for i in batch],
+                    generator=generator,
+                    latents=latents,
                     controlnet=controlnet,
                     controlnet_image=controlnet_image,
                 )
 
-            image = pipeline.latents_to_image(latents)[0]
+            images = pipeline.latents_to_image(latents)
 
-            ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
-            num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
-            seed_suffix = "" if seed is None else f"_{seed}"
-            img_filename = (
-                f"{'' if args.output_name is None else args.output_name + '_'}{ts_str}_{num_suffix}_{i:02d}{seed_suffix}.png"
-            )
+            for i, image in zip(batch, images):
+                seed = prompts[i]["seed"]
+                ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
+                num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
+                seed_suffix = "" if seed is None else f"_{seed}"
+                img_filename = (
+                    f"{'' if args.output_name is None else args.output_name + '_'}{ts_str}_{num_suffix}_{i:02d}{seed_suffix}.png"
+                )
 
-            image.save(os.path.join(save_dir, img_filename))
+                image.save(os.path.join(save_dir, img_filename))
 
-            # wandb有効時のみログを送信
-            try:
-                wandb_tracker = accelerator.get_tracker("wandb")
+                # wandb有効時のみログを送信
                 try:
-                    import wandb
-                except ImportError:  # 事前に一度確認するのでここはエラー出ないはず
-                    raise ImportError("No wandb / wandb がインストールされていないようです")
-
-                wandb_tracker.log({f"sample_{i}": wandb.Image(image)})
-            except:  # wandb 無効時
-                pass
-
-    # clear pipeline and cache to reduce vram usage
-    del pipeline
-    torch.cuda.empty_cache()
+                    wandb_tracker = accelerator.get_tracker("wandb")
+                    try:
+                        import wandb
+                    except ImportError:  # 事前に一度確認するのでここはエラー出ないはず
+                        raise ImportError("No wandb / wandb がインストールされていないようです")
 
-    torch.set_rng_state(rng_state)
-    if cuda_rng_state is not None:
-        torch.cuda.set_rng_state(cuda_rng_state)
-    vae.to(org_vae_device)
+                    wandb_tracker.log({f"sample_{i}": wandb.Image(image)})
+                except:  # wandb 無効時
+                    pass
 
 
 # endregion
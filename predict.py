@@ -1,15 +1,25 @@
+import copy
+import hashlib
+import io
 import json
 import os
 import re
 import shutil
 import subprocess
+import tempfile
 import time
 import platform
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from cog import BasePredictor, Input, Path
+from PIL import Image
 from diffusers import (
     DDIMScheduler,
     DiffusionPipeline,
@@ -21,7 +31,7 @@ from diffusers import (
     StableDiffusionXLImg2ImgPipeline,
     StableDiffusionXLInpaintPipeline,
 )
-from diffusers.models.attention_processor import LoRAAttnProcessor2_0
+from diffusers.models.attention_processor import AttnProcessor2_0, LoRAAttnProcessor2_0
 from diffusers.pipelines.stable_diffusion.safety_checker import (
     StableDiffusionSafetyChecker,
 )
@@ -41,6 +51,47 @@ REFINER_URL = (
     "https://weights.replicate.delivery/default/sdxl/refiner-no-vae-no-encoder-1.0.tar"
 )
 SAFETY_URL = "https://weights.replicate.delivery/default/sdxl/safety-1.0.tar"
+PROMPT_CACHE_SIZE = 64
+# The refiner (and optionally the safety checker) are only loaded on first use, and moved
+# to the cpu after being idle for the given number of seconds. 0 keeps them on the gpu.
+LAZY_REFINER = os.environ.get("LAZY_REFINER", "1") == "1"
+LAZY_SAFETY_CHECKER = os.environ.get("LAZY_SAFETY_CHECKER", "0") == "1"
+REFINER_IDLE_TIMEOUT = float(os.environ.get("REFINER_IDLE_TIMEOUT", "0"))
+SAFETY_CHECKER_IDLE_TIMEOUT = float(os.environ.get("SAFETY_CHECKER_IDLE_TIMEOUT", "0"))
+# LoRAs selectable per prediction with `lora_id`. Each one is a directory in LORA_ROOT laid
+# out like the trained weights (lora.safetensors, embeddings.pti, special_params.json).
+LORA_ROOT = os.environ.get("LORA_ROOT", "./loras")
+LORA_GPU_CACHE_SIZE = int(os.environ.get("LORA_GPU_CACHE_SIZE", "4"))
+LORA_CPU_CACHE_SIZE = int(os.environ.get("LORA_CPU_CACHE_SIZE", "16"))
+# Merge the trained LoRA into the unet attention weights instead of running it as extra
+# low-rank matmuls every step. It is fused at FUSED_LORA_SCALE, and unfused and fused
+# again at the new scale when a prediction asks for another lora_scale.
+FUSE_LORA = os.environ.get("FUSE_LORA", "0") == "1"
+FUSED_LORA_SCALE = float(os.environ.get("FUSED_LORA_SCALE", "0.6"))
+# Outputs are encoded in memory and written once into a directory unique to the request.
+# Point OUTPUT_DIR at a tmpfs (e.g. /dev/shm) to keep them off the disk entirely. The
+# directories are removed OUTPUT_DIR_TTL seconds after they were written, long after Cog
+# uploaded the outputs, however many predictions run concurrently.
+OUTPUT_DIR = os.environ.get("OUTPUT_DIR", tempfile.gettempdir())
+OUTPUT_DIR_TTL = float(os.environ.get("OUTPUT_DIR_TTL", "600"))
+OUTPUT_FORMATS = {"png": "PNG", "webp": "WEBP", "jpg": "JPEG"}
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", "4"))
+# "sync" checks the outputs before returning them, "async" checks them in the background
+# after the prediction returned, "off" skips the safety checker. async does not filter
+# anything: flagged images and checker errors are only logged, the outputs are returned
+# either way.
+SAFETY_CHECKER_MODE = os.environ.get("SAFETY_CHECKER_MODE", "sync")
+# Have the pipelines return gpu tensors and resize/normalize them for the safety checker
+# on the gpu, instead of going through PIL and the CLIPImageProcessor on the cpu.
+SAFETY_CHECKER_GPU_PREPROCESS = os.environ.get("SAFETY_CHECKER_GPU_PREPROCESS", "0") == "1"
+IMAGE_OUTPUT_TYPE = "pt" if SAFETY_CHECKER_GPU_PREPROCESS else "pil"
+# Decode latents larger than VAE_TILE_SIZE pixels in overlapping tiles blended at the
+# seams, so the VAE peak memory stays that of a single tile. VAE_SLICING decodes the
+# images of a batch one at a time.
+VAE_TILING = os.environ.get("VAE_TILING", "0") == "1"
+VAE_TILE_SIZE = int(os.environ.get("VAE_TILE_SIZE", "1024"))
+VAE_TILE_OVERLAP = float(os.environ.get("VAE_TILE_OVERLAP", "0.25"))
+VAE_SLICING = os.environ.get("VAE_SLICING", "0") == "1"
 
 
 class KarrasDPM:
@@ -74,6 +125,482 @@ def download_weights(url, dest):
     print("downloading took: ", time.time() - start)
 
 
+def build_lora_attn_procs(unet, tensors: Dict[str, torch.Tensor], device="cpu"):
+    """
+    Builds the LoRA attention processors of `unet` from a saved LoRA state dict, with the
+    weights loaded. The rank of each processor is read from the shape of its up weights.
+    """
+    name_rank_map = {}
+    for tk, tv in tensors.items():
+        # up is N, d
+        if tk.endswith("up.weight"):
+            proc_name = ".".join(tk.split(".")[:-3])
+            r = tv.shape[1]
+            name_rank_map[proc_name] = r
+
+    unet_lora_attn_procs = {}
+    for name, attn_processor in unet.attn_processors.items():
+        cross_attention_dim = (
+            None
+            if name.endswith("attn1.processor")
+            else unet.config.cross_attention_dim
+        )
+        if name.startswith("mid_block"):
+            hidden_size = unet.config.block_out_channels[-1]
+        elif name.startswith("up_blocks"):
+            block_id = int(name[len("up_blocks.")])
+            hidden_size = list(reversed(unet.config.block_out_channels))[block_id]
+        elif name.startswith("down_blocks"):
+            block_id = int(name[len("down_blocks.")])
+            hidden_size = unet.config.block_out_channels[block_id]
+
+        module = LoRAAttnProcessor2_0(
+            hidden_size=hidden_size,
+            cross_attention_dim=cross_attention_dim,
+            rank=name_rank_map[name],
+        )
+        prefix = name + "."
+        module.load_state_dict(
+            {k[len(prefix) :]: v for k, v in tensors.items() if k.startswith(prefix)}
+        )
+        unet_lora_attn_procs[name] = module.to(device)
+
+    return unet_lora_attn_procs
+
+
+def configure_vae(
+    vae,
+    tiling: bool = VAE_TILING,
+    tile_size: int = VAE_TILE_SIZE,
+    tile_overlap: float = VAE_TILE_OVERLAP,
+    slicing: bool = VAE_SLICING,
+):
+    vae.enable_tiling(tiling)
+    vae.tile_sample_min_size = tile_size
+    vae.tile_latent_min_size = tile_size // 2 ** (len(vae.config.block_out_channels) - 1)
+    vae.tile_overlap_factor = tile_overlap
+    if slicing:
+        vae.enable_slicing()
+    else:
+        vae.disable_slicing()
+
+
+def encode_image(
+    image: Image.Image,
+    output_format: str = "png",
+    output_quality: int = 90,
+    png_compress_level: int = 6,
+) -> bytes:
+    buffer = io.BytesIO()
+    if output_format == "png":
+        image.save(buffer, format="PNG", compress_level=png_compress_level)
+    else:
+        image.save(buffer, format=OUTPUT_FORMATS[output_format], quality=output_quality)
+    return buffer.getvalue()
+
+
+def log_safety_result(future: Future):
+    """Reports the result of a safety check run in the background."""
+    try:
+        has_nsfw_content = future.result()
+    except Exception as e:
+        print(f"async safety checker failed: {e!r}")
+        return
+    flagged = [i for i, nsfw in enumerate(has_nsfw_content) if nsfw]
+    if flagged:
+        print(f"async safety checker flagged images {flagged}, they were returned unfiltered")
+
+
+class FusedLora:
+    """
+    Merges LoRA attention processors into the base `to_q/to_k/to_v/to_out` weights of the
+    unet, so the plain attention processors run with no extra work per step. The touched
+    weights are copied to the cpu the first time, `unfuse` restores them from that copy
+    and puts the LoRA processors back, so fusing again never accumulates rounding error.
+    """
+
+    def __init__(self, unet, procs: Dict[str, LoRAAttnProcessor2_0]):
+        self.unet = unet
+        self.procs = procs
+        self.scale = None
+        self.originals = None
+
+    def _layers(self):
+        for name, proc in self.procs.items():
+            attn = self.unet.get_submodule(name[: -len(".processor")])
+            yield attn.to_q, proc.to_q_lora
+            yield attn.to_k, proc.to_k_lora
+            yield attn.to_v, proc.to_v_lora
+            yield attn.to_out[0], proc.to_out_lora
+
+    @torch.no_grad()
+    def _apply(self, scale: float):
+        if self.originals is None:
+            self.originals = [
+                linear.weight.detach().to("cpu", copy=True) for linear, _ in self._layers()
+            ]
+        for linear, lora in self._layers():
+            weight = linear.weight
+            delta = lora.up.weight.float() @ lora.down.weight.float()
+            if getattr(lora, "network_alpha", None) is not None:
+                delta *= lora.network_alpha / lora.down.weight.shape[0]
+            delta = delta.to(weight.device) * scale
+            weight.copy_((weight.float() + delta).to(weight.dtype))
+
+    def fuse(self, scale: float):
+        if self.scale == scale:
+            return
+        start = time.time()
+        self.unfuse()
+        self._apply(scale)
+        self.unet.set_attn_processor(AttnProcessor2_0())
+        self.scale = scale
+        print(f"Fused LoRA at scale {scale} in {time.time() - start:.2f}s")
+
+    @torch.no_grad()
+    def unfuse(self):
+        if self.scale is None:
+            return
+        for (linear, _), original in zip(self._layers(), self.originals):
+            linear.weight.copy_(original)
+        # set_attn_processor consumes the dict it is given
+        self.unet.set_attn_processor(dict(self.procs))
+        self.scale = None
+
+
+class SchedulerCache:
+    """
+    Scheduler templates built once per (scheduler class, config). `get` hands out a copy,
+    so every request steps its own scheduler and the pipelines' schedulers are never
+    replaced or shared between concurrent requests.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheduler_cls, config):
+        key = (scheduler_cls, json.dumps(dict(config), sort_keys=True, default=str))
+        with self._lock:
+            if key not in self.templates:
+                self.templates[key] = scheduler_cls.from_config(config)
+            template = self.templates[key]
+        return copy.deepcopy(template)
+
+
+def with_scheduler(pipe, scheduler, watermark: bool = True):
+    """
+    A shallow copy of `pipe` sharing all its models, with its own scheduler and watermark
+    setting, for a single call.
+    """
+    pipe = copy.copy(pipe)
+    pipe.scheduler = scheduler
+    if not watermark:
+        pipe.watermark = None
+    return pipe
+
+
+class PromptEmbeddingsCache:
+    """
+    LRU cache of text encoder outputs. Entries are keyed by the prompt text (after token
+    substitution), the version of the loaded token embeddings and active LoRA, and the
+    encoder that produced them, since the refiner only uses the second text encoder.
+    """
+
+    def __init__(self, max_size: int = PROMPT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    def get(self, pipe, encoder: str, text: str, version: Hashable):
+        with self._lock:
+            return self._get(pipe, encoder, text, version)
+
+    def _get(self, pipe, encoder: str, text: str, version: Hashable):
+        key = (text, version, encoder)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        self.misses += 1
+        prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(
+            prompt=text,
+            device="cuda",
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=False,
+        )
+        self.entries[key] = (prompt_embeds, pooled_prompt_embeds)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return self.entries[key]
+
+    def embeds_args(
+        self,
+        pipe,
+        encoder: str,
+        prompt: str,
+        negative_prompt: str,
+        version: Hashable,
+        batch_size: int,
+    ):
+        """
+        Returns the prompt embedding arguments of a pipeline call for `batch_size` images.
+        """
+        prompt_embeds, pooled_prompt_embeds = self.get(pipe, encoder, prompt, version)
+        negative_prompt_embeds, negative_pooled_prompt_embeds = self.get(
+            pipe, encoder, negative_prompt, version
+        )
+        return {
+            "prompt_embeds": prompt_embeds.repeat(batch_size, 1, 1),
+            "pooled_prompt_embeds": pooled_prompt_embeds.repeat(batch_size, 1),
+            "negative_prompt_embeds": negative_prompt_embeds.repeat(batch_size, 1, 1),
+            "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds.repeat(batch_size, 1),
+        }
+
+    def clear(self):
+        self.entries.clear()
+
+
+@contextmanager
+def timed(name: str, timings: Optional[Dict[str, float]] = None):
+    start = time.time()
+    yield
+    elapsed = time.time() - start
+    if timings is not None:
+        timings[name] = elapsed
+    print(f"{name} took: {elapsed:.2f}s")
+
+
+class LazyComponent:
+    """
+    A model that is only built the first time it is used. If `idle_timeout` is set, it is
+    moved off the gpu with `offload` after that many idle seconds, and brought back with
+    `onload` on the next use.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[], Any],
+        offload: Optional[Callable[[Any], Any]] = None,
+        onload: Optional[Callable[[Any], Any]] = None,
+        idle_timeout: float = 0,
+        timings: Optional[Dict[str, float]] = None,
+    ):
+        self.name = name
+        self.loader = loader
+        self.offload = offload
+        self.onload = onload
+        self.idle_timeout = idle_timeout
+        self.timings = timings
+
+        self.component = None
+        self.offloaded = False
+        self.active = 0
+        self.last_used = time.monotonic()
+        self._lock = threading.RLock()
+
+        if idle_timeout > 0 and offload is not None:
+            threading.Thread(
+                target=self._watch_idle, name=f"idle-{name}", daemon=True
+            ).start()
+
+    def load(self):
+        with self._lock:
+            if self.component is None:
+                with timed(self.name, self.timings):
+                    self.component = self.loader()
+            elif self.offloaded:
+                with timed(f"{self.name} onload", self.timings):
+                    self.onload(self.component)
+                self.offloaded = False
+            return self.component
+
+    @contextmanager
+    def use(self):
+        with self._lock:
+            component = self.load()
+            self.active += 1
+        try:
+            yield component
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.last_used = time.monotonic()
+
+    def _watch_idle(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 10))
+            with self._lock:
+                if (
+                    self.component is not None
+                    and not self.offloaded
+                    and self.active == 0
+                    and time.monotonic() - self.last_used > self.idle_timeout
+                ):
+                    print(f"Offloading idle {self.name} to cpu")
+                    self.offload(self.component)
+                    self.offloaded = True
+                    torch.cuda.empty_cache()
+
+
+class LoraRegistry:
+    """
+    Keeps several LoRA + PTI bundles in memory and swaps them into the shared unet and text
+    encoders per prediction. Activating a LoRA only replaces the attention processors and
+    writes the few inserted token rows, the base weights are never reloaded.
+
+    The `max_gpu` most recently used LoRAs stay on the gpu, up to `max_cpu` more are kept
+    on the cpu, older ones are dropped and read from disk again when requested. `None`
+    restores the processors and token embeddings the pipeline was set up with. If the
+    model's own LoRA is `fused`, it is unfused while another LoRA is active.
+    """
+
+    def __init__(
+        self,
+        unet,
+        text_encoders,
+        tokenizers,
+        root: str = LORA_ROOT,
+        max_gpu: int = LORA_GPU_CACHE_SIZE,
+        max_cpu: int = LORA_CPU_CACHE_SIZE,
+        fused: Optional[FusedLora] = None,
+    ):
+        self.unet = unet
+        self.fused = fused
+        self.handler = TokenEmbeddingsHandler(text_encoders, tokenizers)
+        self.root = root
+        self.max_gpu = max_gpu
+        self.max_cpu = max_cpu
+
+        self.entries = OrderedDict()
+        self.active = None
+        self._lock = threading.RLock()
+
+        # what the pipeline was set up with, restored for `lora_id=None`
+        self.default_procs = dict(unet.attn_processors)
+        self.default_rows = []
+        for tokenizer, text_encoder in zip(tokenizers, text_encoders):
+            ids = tokenizer.convert_tokens_to_ids(tokenizer.additional_special_tokens)
+            weight = text_encoder.text_model.embeddings.token_embedding.weight
+            self.default_rows.append((ids, weight.data[ids].clone()))
+
+    def _path(self, lora_id: str) -> str:
+        if lora_id.startswith("http://") or lora_id.startswith("https://"):
+            name = hashlib.sha256(lora_id.encode()).hexdigest()[:16]
+            path = os.path.join(self.root, name)
+            if not os.path.exists(path):
+                download_weights(lora_id, path)
+            return path
+        # ids come from the request, they must name a directory right under the root
+        path = os.path.realpath(os.path.join(self.root, lora_id))
+        if (
+            "/" in lora_id
+            or "\\" in lora_id
+            or lora_id in ("", ".", "..")
+            or os.path.dirname(path) != os.path.realpath(self.root)
+        ):
+            raise ValueError(f"Invalid lora_id: {lora_id!r}")
+        return path
+
+    def _load(self, lora_id: str) -> Dict[str, Any]:
+        path = self._path(lora_id)
+        start = time.time()
+        with safe_open(
+            os.path.join(path, "lora.safetensors"), framework="pt", device="cpu"
+        ) as f:
+            tensors = {k: f.get_tensor(k) for k in f.keys()}
+        embeddings = []
+        with safe_open(
+            os.path.join(path, "embeddings.pti"), framework="pt", device="cpu"
+        ) as f:
+            for idx in range(len(self.handler.text_encoders)):
+                embeddings.append(f.get_tensor(f"text_encoders_{idx}"))
+        with open(os.path.join(path, "special_params.json"), "r") as f:
+            token_map = json.load(f)
+
+        entry = {
+            "procs": build_lora_attn_procs(self.unet, tensors),
+            "embeddings": embeddings,
+            "token_map": token_map,
+            "device": "cpu",
+        }
+        print(f"Loaded LoRA {lora_id} in {time.time() - start:.2f}s")
+        return entry
+
+    def get(self, lora_id: str) -> Dict[str, Any]:
+        with self._lock:
+            if lora_id not in self.entries:
+                self.entries[lora_id] = self._load(lora_id)
+            self.entries.move_to_end(lora_id)
+            self._evict()
+            return self.entries[lora_id]
+
+    def token_map(self, lora_id: str) -> Dict[str, str]:
+        return self.get(lora_id)["token_map"]
+
+    def _evict(self):
+        # most recently used last
+        ids = list(self.entries)
+        for i, lora_id in enumerate(reversed(ids)):
+            if lora_id == self.active:
+                continue
+            entry = self.entries[lora_id]
+            if i >= self.max_gpu + self.max_cpu:
+                del self.entries[lora_id]
+            elif i >= self.max_gpu and entry["device"] != "cpu":
+                for proc in entry["procs"].values():
+                    proc.to("cpu")
+                entry["device"] = "cpu"
+
+    def activate(self, lora_id: Optional[str]):
+        with self._lock:
+            if lora_id == self.active:
+                return
+            start = time.time()
+            if lora_id is None:
+                # a fused LoRA comes back unfused, the prediction fuses it at its scale
+                procs = self.fused.procs if self.fused is not None else self.default_procs
+                self.unet.set_attn_processor(dict(procs))
+                for (ids, rows), text_encoder in zip(
+                    self.default_rows, self.handler.text_encoders
+                ):
+                    weight = text_encoder.text_model.embeddings.token_embedding.weight
+                    weight.data[ids] = rows
+            else:
+                if self.fused is not None:
+                    self.fused.unfuse()
+                entry = self.get(lora_id)
+                if entry["device"] != "cuda":
+                    for proc in entry["procs"].values():
+                        proc.to("cuda")
+                    entry["device"] = "cuda"
+                # set_attn_processor consumes the dict it is given
+                self.unet.set_attn_processor(dict(entry["procs"]))
+                for embeddings, tokenizer, text_encoder in zip(
+                    entry["embeddings"],
+                    self.handler.tokenizers,
+                    self.handler.text_encoders,
+                ):
+                    self.handler._load_embeddings(embeddings, tokenizer, text_encoder)
+            self.active = lora_id
+            self._evict()
+            print(f"Activated LoRA {lora_id} in {time.time() - start:.2f}s")
+
+    @contextmanager
+    def activated(self, lora_id: Optional[str]):
+        """
+        Holds the registry while a prediction runs with `lora_id`, so concurrent
+        predictions can't swap the weights underneath it.
+        """
+        with self._lock:
+            self.activate(lora_id)
+            yield
+
+
 class Predictor(BasePredictor):
     def load_trained_weights(self, weights, pipe):
         local_weights_cache = "./training_out"
@@ -111,42 +638,12 @@ class Predictor(BasePredictor):
 
             tensors = load_file(os.path.join(local_weights_cache, "lora.safetensors"))
 
-            unet = pipe.unet
-            unet_lora_attn_procs = {}
-            name_rank_map = {}
-            for tk, tv in tensors.items():
-                # up is N, d
-                if tk.endswith("up.weight"):
-                    proc_name = ".".join(tk.split(".")[:-3])
-                    r = tv.shape[1]
-                    name_rank_map[proc_name] = r
-
-            for name, attn_processor in unet.attn_processors.items():
-                cross_attention_dim = (
-                    None
-                    if name.endswith("attn1.processor")
-                    else unet.config.cross_attention_dim
-                )
-                if name.startswith("mid_block"):
-                    hidden_size = unet.config.block_out_channels[-1]
-                elif name.startswith("up_blocks"):
-                    block_id = int(name[len("up_blocks.")])
-                    hidden_size = list(reversed(unet.config.block_out_channels))[
-                        block_id
-                    ]
-                elif name.startswith("down_blocks"):
-                    block_id = int(name[len("down_blocks.")])
-                    hidden_size = unet.config.block_out_channels[block_id]
-
-                module = LoRAAttnProcessor2_0(
-                    hidden_size=hidden_size,
-                    cross_attention_dim=cross_attention_dim,
-                    rank=name_rank_map[name],
-                )
-                unet_lora_attn_procs[name] = module.to("cuda")
-
-            unet.set_attn_processor(unet_lora_attn_procs)
-            unet.load_state_dict(tensors, strict=False)
+            procs = build_lora_attn_procs(unet, tensors, "cuda")
+            # set_attn_processor consumes the dict it is given
+            unet.set_attn_processor(dict(procs))
+            if FUSE_LORA:
+                self.fused_lora = FusedLora(unet, procs)
+                self.fused_lora.fuse(FUSED_LORA_SCALE)
 
         # load text
         handler = TokenEmbeddingsHandler(
@@ -160,35 +657,58 @@ class Predictor(BasePredictor):
         self.token_map = params
 
         self.tuned_model = True
+        # the token embeddings changed, cached prompt embeddings are stale
+        self.embeddings_version += 1
 
     def setup(self, weights: Optional[Path] = None):
         """Load the model into memory to make running multiple predictions efficient"""
         start = time.time()
         self.tuned_model = False
+        self.embeddings_version = 0
+        self.prompt_cache = PromptEmbeddingsCache(PROMPT_CACHE_SIZE)
+        self.scheduler_cache = SchedulerCache()
 
-        print("Loading safety checker...")
-        if not os.path.exists(SAFETY_CACHE):
-            download_weights(SAFETY_URL, SAFETY_CACHE)
-        self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(
-            SAFETY_CACHE, torch_dtype=torch.float16
-        ).to("cuda")
-        self.feature_extractor = CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR)
+        self.load_timings = {}
+        self.encode_pool = ThreadPoolExecutor(ENCODE_WORKERS)
+        self.output_dirs = deque()  # (creation time, path), oldest first
+        self.output_dirs_lock = threading.Lock()
+        self.safety_pool = ThreadPoolExecutor(1)
 
-        if not os.path.exists(SDXL_MODEL_CACHE):
-            download_weights(SDXL_URL, SDXL_MODEL_CACHE)
+        self.safety_checker = LazyComponent(
+            "safety checker",
+            self.load_safety_checker,
+            offload=lambda checker: checker.to("cpu"),
+            onload=lambda checker: checker.to("cuda"),
+            idle_timeout=SAFETY_CHECKER_IDLE_TIMEOUT,
+            timings=self.load_timings,
+        )
+        if not LAZY_SAFETY_CHECKER and SAFETY_CHECKER_MODE != "off":
+            self.safety_checker.load()
+        with timed("feature extractor", self.load_timings):
+            self.feature_extractor = CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR)
+
+        with timed("sdxl download", self.load_timings):
+            if not os.path.exists(SDXL_MODEL_CACHE):
+                download_weights(SDXL_URL, SDXL_MODEL_CACHE)
 
         print("Loading sdxl txt2img pipeline...")
-        self.txt2img_pipe = DiffusionPipeline.from_pretrained(
-            SDXL_MODEL_CACHE,
-            torch_dtype=torch.float16,
-            use_safetensors=True,
-            variant="fp16",
-        )
+        with timed("sdxl txt2img pipeline", self.load_timings):
+            self.txt2img_pipe = DiffusionPipeline.from_pretrained(
+                SDXL_MODEL_CACHE,
+                torch_dtype=torch.float16,
+                use_safetensors=True,
+                variant="fp16",
+            )
         self.is_lora = False
+        self.fused_lora = None
         if weights or os.path.exists("./trained-model"):
-            self.load_trained_weights(weights, self.txt2img_pipe)
+            with timed("trained weights", self.load_timings):
+                self.load_trained_weights(weights, self.txt2img_pipe)
 
-        self.txt2img_pipe.to("cuda")
+        with timed("sdxl to cuda", self.load_timings):
+            self.txt2img_pipe.to("cuda")
+        # the vae is shared by all the pipelines, refiner included
+        configure_vae(self.txt2img_pipe.vae)
 
         print("Loading SDXL img2img pipeline...")
         self.img2img_pipe = StableDiffusionXLImg2ImgPipeline(
@@ -214,6 +734,40 @@ class Predictor(BasePredictor):
         )
         self.inpaint_pipe.to("cuda")
 
+        self.lora_registry = LoraRegistry(
+            self.txt2img_pipe.unet,
+            [self.txt2img_pipe.text_encoder, self.txt2img_pipe.text_encoder_2],
+            [self.txt2img_pipe.tokenizer, self.txt2img_pipe.tokenizer_2],
+            fused=self.fused_lora,
+        )
+
+        # The refiner shares the vae and text_encoder_2 of the base pipeline, so only its
+        # own unet is moved to the cpu when it sits idle.
+        self.refiner = LazyComponent(
+            "refiner",
+            self.load_refiner,
+            offload=lambda refiner: refiner.unet.to("cpu"),
+            onload=lambda refiner: refiner.unet.to("cuda"),
+            idle_timeout=REFINER_IDLE_TIMEOUT,
+            timings=self.load_timings,
+        )
+        if not LAZY_REFINER:
+            self.refiner.load()
+
+        print("setup took: ", time.time() - start)
+        for name, seconds in self.load_timings.items():
+            print(f"  {name}: {seconds:.2f}s")
+        # self.txt2img_pipe.__class__.encode_prompt = new_encode_prompt
+
+    def load_safety_checker(self):
+        print("Loading safety checker...")
+        if not os.path.exists(SAFETY_CACHE):
+            download_weights(SAFETY_URL, SAFETY_CACHE)
+        return StableDiffusionSafetyChecker.from_pretrained(
+            SAFETY_CACHE, torch_dtype=torch.float16
+        ).to("cuda")
+
+    def load_refiner(self):
         print("Loading SDXL refiner pipeline...")
         # FIXME(ja): should the vae/text_encoder_2 be loaded from SDXL always?
         #            - in the case of fine-tuned SDXL should we still?
@@ -224,7 +778,7 @@ class Predictor(BasePredictor):
             download_weights(REFINER_URL, REFINER_MODEL_CACHE)
 
         print("Loading refiner pipeline...")
-        self.refiner = DiffusionPipeline.from_pretrained(
+        refiner = DiffusionPipeline.from_pretrained(
             REFINER_MODEL_CACHE,
             text_encoder_2=self.txt2img_pipe.text_encoder_2,
             vae=self.txt2img_pipe.vae,
@@ -232,25 +786,71 @@ class Predictor(BasePredictor):
             use_safetensors=True,
             variant="fp16",
         )
-        self.refiner.to("cuda")
-        print("setup took: ", time.time() - start)
-        # self.txt2img_pipe.__class__.encode_prompt = new_encode_prompt
+        refiner.to("cuda")
+        return refiner
 
     def load_image(self, path):
-        shutil.copyfile(path, "/tmp/image.png")
-        return load_image("/tmp/image.png").convert("RGB")
+        # read straight into memory, there is no shared file to race on
+        with open(path, "rb") as f:
+            image = Image.open(io.BytesIO(f.read()))
+        return load_image(image).convert("RGB")
 
     def run_safety_checker(self, image):
         safety_checker_input = self.feature_extractor(image, return_tensors="pt").to(
             "cuda"
         )
         np_image = [np.array(val) for val in image]
-        image, has_nsfw_concept = self.safety_checker(
-            images=np_image,
-            clip_input=safety_checker_input.pixel_values.to(torch.float16),
+        with self.safety_checker.use() as safety_checker:
+            image, has_nsfw_concept = safety_checker(
+                images=np_image,
+                clip_input=safety_checker_input.pixel_values.to(torch.float16),
+            )
+        return image, has_nsfw_concept
+
+    def run_safety_checker_tensor(self, images: torch.Tensor):
+        """
+        Same as `run_safety_checker` for n x 3 x h x w images in [0, 1] on the gpu. The
+        CLIPImageProcessor resize, center crop and normalization are done on the device.
+        """
+        crop = self.feature_extractor.crop_size["height"]
+        shortest_edge = self.feature_extractor.size["shortest_edge"]
+        h, w = images.shape[-2:]
+        scale = shortest_edge / min(h, w)
+        clip_input = F.interpolate(
+            images.float(),
+            size=(max(crop, round(h * scale)), max(crop, round(w * scale))),
+            mode="bicubic",
+            align_corners=False,
+            antialias=True,
         )
+        top = (clip_input.shape[-2] - crop) // 2
+        left = (clip_input.shape[-1] - crop) // 2
+        clip_input = clip_input[..., top : top + crop, left : left + crop]
+        mean = torch.tensor(self.feature_extractor.image_mean, device=images.device)
+        std = torch.tensor(self.feature_extractor.image_std, device=images.device)
+        clip_input = (clip_input - mean.view(1, 3, 1, 1)) / std.view(1, 3, 1, 1)
+
+        with self.safety_checker.use() as safety_checker:
+            # a list, so flagged images are replaced in it rather than zeroed in place
+            image, has_nsfw_concept = safety_checker(
+                images=list(images),
+                clip_input=clip_input.to(torch.float16),
+            )
         return image, has_nsfw_concept
 
+    @torch.inference_mode()
+    def check_safety(self, images, tensors: Optional[torch.Tensor] = None):
+        start = time.time()
+        if tensors is not None:
+            _, has_nsfw_content = self.run_safety_checker_tensor(tensors)
+        else:
+            _, has_nsfw_content = self.run_safety_checker(images)
+        print(
+            f"safety checker ({SAFETY_CHECKER_MODE}) took: {time.time() - start:.2f}s, "
+            f"{sum(has_nsfw_content)} of {len(has_nsfw_content)} images flagged"
+        )
+        return has_nsfw_content
+
     @torch.inference_mode()
     def predict(
         self,
@@ -329,6 +929,27 @@ class Predictor(BasePredictor):
             le=1.0,
             default=0.6,
         ),
+        lora_id: str = Input(
+            description="LoRA to use for this prediction: a directory name in LORA_ROOT or a url to a trained weights tar. Leave blank to use the model's own weights.",
+            default=None,
+        ),
+        output_format: str = Input(
+            description="Format of the output images",
+            choices=list(OUTPUT_FORMATS.keys()),
+            default="png",
+        ),
+        output_quality: int = Input(
+            description="Quality of webp and jpg outputs, from 1 to 100. Ignored for png.",
+            ge=1,
+            le=100,
+            default=90,
+        ),
+        png_compress_level: int = Input(
+            description="zlib compression level of png outputs, 0 is fastest and largest, 9 is slowest and smallest.",
+            ge=0,
+            le=9,
+            default=6,
+        ),
     ) -> List[Path]:
         """Run a single prediction on the model"""
         if seed is None:
@@ -336,10 +957,14 @@ class Predictor(BasePredictor):
         print(f"Using seed: {seed}")
 
         sdxl_kwargs = {}
-        if self.tuned_model:
-            # consistency with fine-tuning API
-            for k, v in self.token_map.items():
-                prompt = prompt.replace(k, v)
+        token_map = self.token_map if self.tuned_model else {}
+        if lora_id:
+            token_map = self.lora_registry.token_map(lora_id)
+        else:
+            lora_id = None
+        # consistency with fine-tuning API
+        for k, v in token_map.items():
+            prompt = prompt.replace(k, v)
         print(f"Prompt: {prompt}")
         if image and mask:
             print("inpainting mode")
@@ -365,55 +990,120 @@ class Predictor(BasePredictor):
             sdxl_kwargs["denoising_end"] = high_noise_frac
         elif refine == "base_image_refiner":
             sdxl_kwargs["output_type"] = "latent"
+        else:
+            sdxl_kwargs["output_type"] = IMAGE_OUTPUT_TYPE
 
         if apply_watermark:
             print('toggles watermark for this prediction...')
-            watermark_cache = pipe.watermark
-            pipe.watermark = None
-            self.refiner.watermark = None
-
-        pipe.scheduler = SCHEDULERS[scheduler].from_config(pipe.scheduler.config)
-        generator = torch.Generator("cuda").manual_seed(seed)
-
-        common_args = {
-            "prompt": [prompt] * num_outputs,
-            "negative_prompt": [negative_prompt] * num_outputs,
-            "guidance_scale": guidance_scale,
-            "generator": generator,
-            "num_inference_steps": num_inference_steps,
-        }
-
-        if self.is_lora:
-            sdxl_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
 
-        output = pipe(**common_args, **sdxl_kwargs)
+        with self.lora_registry.activated(lora_id):
+            pipe = with_scheduler(
+                pipe,
+                self.scheduler_cache.get(SCHEDULERS[scheduler], pipe.scheduler.config),
+                watermark=not apply_watermark,
+            )
+            generator = torch.Generator("cuda").manual_seed(seed)
 
-        if refine in ["expert_ensemble_refiner", "base_image_refiner"]:
-            refiner_kwargs = {
-                "image": output.images,
+            hits, misses = self.prompt_cache.hits, self.prompt_cache.misses
+            common_args = {
+                "guidance_scale": guidance_scale,
+                "generator": generator,
+                "num_inference_steps": num_inference_steps,
             }
+            base_embeds = self.prompt_cache.embeds_args(
+                pipe,
+                "base",
+                prompt,
+                negative_prompt,
+                (self.embeddings_version, lora_id),
+                num_outputs,
+            )
 
-            if refine == "expert_ensemble_refiner":
-                refiner_kwargs["denoising_start"] = high_noise_frac
-            if refine == "base_image_refiner" and refine_steps:
-                common_args["num_inference_steps"] = refine_steps
+            if lora_id is None and self.fused_lora is not None:
+                self.fused_lora.fuse(lora_scale)
+            elif self.is_lora or lora_id is not None:
+                sdxl_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
 
-            output = self.refiner(**common_args, **refiner_kwargs)
+            output = pipe(**common_args, **base_embeds, **sdxl_kwargs)
 
-        if apply_watermark:
-            print('Toggles watermark for this refiner prediction...')
-            pipe.watermark = watermark_cache
-            self.refiner.watermark = watermark_cache
+            if refine in ["expert_ensemble_refiner", "base_image_refiner"]:
+                refiner_kwargs = {
+                    "image": output.images,
+                    "output_type": IMAGE_OUTPUT_TYPE,
+                }
 
-        _, has_nsfw_content = self.run_safety_checker(output.images)
+                if refine == "expert_ensemble_refiner":
+                    refiner_kwargs["denoising_start"] = high_noise_frac
+                if refine == "base_image_refiner" and refine_steps:
+                    common_args["num_inference_steps"] = refine_steps
 
+                with self.refiner.use() as refiner:
+                    refiner = with_scheduler(
+                        refiner,
+                        self.scheduler_cache.get(
+                            type(refiner.scheduler), refiner.scheduler.config
+                        ),
+                        watermark=not apply_watermark,
+                    )
+                    refiner_embeds = self.prompt_cache.embeds_args(
+                        refiner,
+                        "refiner",
+                        prompt,
+                        negative_prompt,
+                        (self.embeddings_version, lora_id),
+                        num_outputs,
+                    )
+                    output = refiner(**common_args, **refiner_embeds, **refiner_kwargs)
+
+            print(
+                f"Prompt cache: {self.prompt_cache.hits - hits} hits, {self.prompt_cache.misses - misses} misses "
+                f"({self.prompt_cache.hits} hits, {self.prompt_cache.misses} misses total)"
+            )
+
+        return self.save_outputs(
+            output.images, output_format, output_quality, png_compress_level
+        )
+
+    def save_outputs(
+        self,
+        images,
+        output_format: str = "png",
+        output_quality: int = 90,
+        png_compress_level: int = 6,
+    ) -> List[Path]:
+        tensors = None
+        if torch.is_tensor(images):
+            tensors = images
+            image_processor = self.txt2img_pipe.image_processor
+            images = image_processor.numpy_to_pil(image_processor.pt_to_numpy(tensors))
+
+        has_nsfw_content = [False] * len(images)
+        if SAFETY_CHECKER_MODE == "sync":
+            has_nsfw_content = self.check_safety(images, tensors)
+        elif SAFETY_CHECKER_MODE == "async":
+            future = self.safety_pool.submit(self.check_safety, images, tensors)
+            future.add_done_callback(log_safety_result)
+
+        start = time.time()
+        encoded = list(
+            self.encode_pool.map(
+                lambda image: encode_image(
+                    image, output_format, output_quality, png_compress_level
+                ),
+                images,
+            )
+        )
+        print(f"encoding {len(images)} images took: {time.time() - start:.2f}s")
+
+        output_dir = self.make_output_dir()
         output_paths = []
         for i, nsfw in enumerate(has_nsfw_content):
             # if nsfw:
             #     print(f"NSFW content detected in image {i}")
             #     continue
-            output_path = f"/tmp/out-{i}.png"
-            output.images[i].save(output_path)
+            output_path = os.path.join(output_dir, f"out-{i}.{output_format}")
+            with open(output_path, "wb") as f:
+                f.write(encoded[i])
             output_paths.append(Path(output_path))
 
         # if len(output_paths) == 0:
@@ -422,3 +1112,16 @@ class Predictor(BasePredictor):
         #     )
 
         return output_paths
+
+    def make_output_dir(self) -> str:
+        """
+        A new directory for the outputs of a request. Directories written more than
+        OUTPUT_DIR_TTL seconds ago are removed.
+        """
+        now = time.time()
+        with self.output_dirs_lock:
+            while self.output_dirs and self.output_dirs[0][0] < now - OUTPUT_DIR_TTL:
+                shutil.rmtree(self.output_dirs.popleft()[1], ignore_errors=True)
+            output_dir = tempfile.mkdtemp(prefix="predict-", dir=OUTPUT_DIR)
+            self.output_dirs.append((now, output_dir))
+        return output_dir
@@ -4,13 +4,21 @@
 
 import gc
 import fnmatch
+import hashlib
+import io
+import itertools
+import math
 import mimetypes
+import multiprocessing
 import os
+import queue
 import re
 import shutil
 import tarfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Literal, Optional, Tuple, Union
+from typing import Iterable, Iterator, List, Literal, Optional, Tuple, Union
 from zipfile import ZipFile
 
 import cv2
@@ -18,7 +26,7 @@ import mediapipe as mp
 import numpy as np
 import pandas as pd
 import torch
-from PIL import Image, ImageFilter
+from PIL import Image, ImageFilter, PngImagePlugin
 from tqdm import tqdm
 from transformers import (
     BlipForConditionalGeneration,
@@ -26,7 +34,6 @@ from transformers import (
     CLIPSegForImageSegmentation,
     CLIPSegProcessor,
     Swin2SRForImageSuperResolution,
-    Swin2SRImageProcessor,
 )
 from library.custom_logging import setup_logging
 
@@ -36,6 +43,11 @@ log = setup_logging()
 MODEL_PATH = "./cache"
 TEMP_OUT_DIR = "./temp/"
 TEMP_IN_DIR = "./temp_in/"
+PREPROCESS_CACHE_DIR = "./preprocess-cache"
+
+CAPTION_MODEL_ID = "Salesforce/blip-image-captioning-large"
+MASK_MODEL_ID = "CIDAS/clipseg-rd64-refined"
+UPSCALE_MODEL_ID = "caidas/swin2SR-realworld-sr-x4-64-bsrgan-psnr"
 
 
 def preprocess(
@@ -48,6 +60,14 @@ def preprocess(
     use_face_detection_instead: bool,
     temp: float,
     substitution_tokens: List[str],
+    batch_size: int = 1,
+    use_cache: bool = True,
+    cache_dir: str = PREPROCESS_CACHE_DIR,
+    cache_max_size_gb: float = 10.0,
+    stream_archive: bool = True,
+    num_workers: int = 0,
+    image_format: Literal["png", "webp"] = "png",
+    png_compress_level: int = 6,
 ) -> Path:
     # assert str(files).endswith(".zip"), "files must be a zip file"
 
@@ -55,42 +75,44 @@ def preprocess(
     
     print(f'Use face detection: {use_face_detection_instead}')
 
-    for path in [TEMP_OUT_DIR, TEMP_IN_DIR]:
-        if os.path.exists(path):
-            shutil.rmtree(path)
-        os.makedirs(path)
+    # TEMP_OUT_DIR is cleaned by load_and_save_masks_and_captions, which keeps the trainer's latent cache
+    if os.path.exists(TEMP_IN_DIR):
+        shutil.rmtree(TEMP_IN_DIR)
+    os.makedirs(TEMP_IN_DIR)
 
-    if input_images_filetype == "zip" or str(input_zip_path).endswith(".zip"):
+    if stream_archive:
+        # decode the images straight from the archive members, nothing is written to TEMP_IN_DIR
+        files = iter_archive_images(input_zip_path, input_images_filetype)
+    elif input_images_filetype == "zip" or str(input_zip_path).endswith(".zip"):
+        files = TEMP_IN_DIR
         with ZipFile(str(input_zip_path), "r") as zip_ref:
             for zip_info in zip_ref.infolist():
-                if zip_info.filename[-1] == "/" or zip_info.filename.startswith(
-                    "__MACOSX"
-                ):
+                if not _is_archive_image(zip_info.filename):
                     continue
-                mt = mimetypes.guess_type(zip_info.filename)
-                if mt and mt[0] and mt[0].startswith("image/"):
-                    zip_info.filename = os.path.basename(zip_info.filename)
-                    zip_ref.extract(zip_info, TEMP_IN_DIR)
+                zip_info.filename = os.path.basename(zip_info.filename)
+                zip_ref.extract(zip_info, TEMP_IN_DIR)
     elif input_images_filetype == "tar" or str(input_zip_path).endswith(".tar"):
+        files = TEMP_IN_DIR
         assert str(input_zip_path).endswith(
             ".tar"
         ), "files must be a tar file if not zip"
         with tarfile.open(input_zip_path, "r") as tar_ref:
             for tar_info in tar_ref:
-                if tar_info.name[-1] == "/" or tar_info.name.startswith("__MACOSX"):
+                if not _is_archive_image(tar_info.name):
                     continue
-
-                mt = mimetypes.guess_type(tar_info.name)
-                if mt and mt[0] and mt[0].startswith("image/"):
-                    tar_info.name = os.path.basename(tar_info.name)
-                    tar_ref.extract(tar_info, TEMP_IN_DIR)
+                tar_info.name = os.path.basename(tar_info.name)
+                tar_ref.extract(tar_info, TEMP_IN_DIR)
     else:
         assert False, "input_images_filetype must be zip or tar"
 
     output_dir: str = TEMP_OUT_DIR
 
+    cache = None
+    if use_cache:
+        cache = PreprocessCache(cache_dir, max_size_bytes=int(cache_max_size_gb * 1024**3))
+
     load_and_save_masks_and_captions(
-        files=TEMP_IN_DIR,
+        files=files,
         output_dir=output_dir,
         caption_text=caption_text,
         mask_target_prompts=mask_target_prompts,
@@ -99,11 +121,227 @@ def preprocess(
         use_face_detection_instead=use_face_detection_instead,
         temp=temp,
         substitution_tokens=substitution_tokens,
+        batch_size=batch_size,
+        cache=cache,
+        num_workers=num_workers,
+        image_format=image_format,
+        png_compress_level=png_compress_level,
     )
 
+    if cache is not None:
+        cache.evict()
+        cache.report()
+
+    # keep the models around on the cpu, but give the VRAM back to training
+    release_models()
+
     return Path(TEMP_OUT_DIR)
 
 
+# the same images load_and_save_masks_and_captions picks up from an extracted directory
+_ARCHIVE_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def _is_archive_image(name: str) -> bool:
+    if name[-1] == "/" or name.startswith("__MACOSX"):
+        return False
+    mt = mimetypes.guess_type(name)
+    if not (mt and mt[0] and mt[0].startswith("image/")):
+        return False
+    return name.lower().endswith(_ARCHIVE_IMAGE_EXTENSIONS)
+
+
+def iter_archive_images(
+    input_zip_path: Path, input_images_filetype: str = "infer"
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yields (member name, image bytes) for every image in a zip or tar archive without extracting it.
+
+    Zip members are read by random access in name order. Tar archives are read as a stream in
+    archive order, so compressed and very large tars are never fully loaded. Members keep their
+    full path inside the archive, so nested folders with the same basenames do not collide.
+    """
+    if input_images_filetype == "zip" or str(input_zip_path).endswith(".zip"):
+        with ZipFile(str(input_zip_path), "r") as zip_ref:
+            names = sorted(
+                info.filename
+                for info in zip_ref.infolist()
+                if _is_archive_image(info.filename)
+            )
+            for name in names:
+                yield name, zip_ref.read(name)
+    elif input_images_filetype == "tar" or str(input_zip_path).endswith(".tar"):
+        with tarfile.open(str(input_zip_path), "r|*") as tar_ref:
+            for tar_info in tar_ref:
+                if not tar_info.isfile() or not _is_archive_image(tar_info.name):
+                    continue
+                yield tar_info.name, tar_ref.extractfile(tar_info).read()
+    else:
+        assert False, "input_images_filetype must be zip or tar"
+
+
+# Models are kept in a process-level registry so that every stage loads its
+# weights once and reuses them across calls instead of re-running from_pretrained.
+_MODEL_REGISTRY = {}
+
+
+def _load_pretrained(model_cls, model_id: str, device=None):
+    """
+    Returns a cached instance of `model_cls` for `model_id`, loading it on first use.
+    Models are moved to `device` if given.
+    """
+    key = (model_cls.__name__, model_id)
+    if key not in _MODEL_REGISTRY:
+        log.info(f"Loading {model_cls.__name__} from {model_id}...")
+        _MODEL_REGISTRY[key] = model_cls.from_pretrained(model_id, cache_dir=MODEL_PATH)
+
+    model = _MODEL_REGISTRY[key]
+    if device is not None:
+        model = model.to(device)
+        _MODEL_REGISTRY[key] = model
+    return model
+
+
+def release_models(offload_to_cpu: bool = True):
+    """
+    Frees the VRAM held by the preprocessing models. With offload_to_cpu the models
+    stay in the registry on the CPU so the next call does not have to reload them.
+    """
+    if offload_to_cpu:
+        for key, model in _MODEL_REGISTRY.items():
+            if isinstance(model, torch.nn.Module):
+                _MODEL_REGISTRY[key] = model.to("cpu")
+    else:
+        _MODEL_REGISTRY.clear()
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _batched(items: Iterable, batch_size: int):
+    batch_size = max(1, batch_size)
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class PreprocessCache:
+    """
+    On-disk cache of per-image preprocessing results (captions, masks and upscaled crops).
+
+    Entries are content-addressed: the key is a hash of the source image bytes together with the
+    model id and the parameters of the stage, so retraining on the same archive with different
+    training settings reuses everything that was already computed. The least recently used entries
+    are evicted once the cache grows beyond `max_size_bytes`.
+    """
+
+    def __init__(self, cache_dir: str = PREPROCESS_CACHE_DIR, max_size_bytes: int = 10 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.stats = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+    def _path(self, kind: str, key: str) -> str:
+        ext = "txt" if kind == "caption" else "png"
+        return os.path.join(self.cache_dir, kind, key[:2], f"{key}.{ext}")
+
+    def _count(self, kind: str, hit: bool):
+        with self._lock:
+            hits, misses = self.stats.get(kind, (0, 0))
+            self.stats[kind] = (hits + 1, misses) if hit else (hits, misses + 1)
+
+    def get(self, kind: str, key: str) -> Optional[Union[str, Image.Image]]:
+        path = self._path(kind, key)
+        if not os.path.exists(path):
+            self._count(kind, False)
+            return None
+
+        try:
+            if kind == "caption":
+                with open(path, "r", encoding="utf-8") as f:
+                    value = f.read()
+            else:
+                with Image.open(path) as image:
+                    image.load()
+                    value = image.copy()
+        except OSError:
+            log.warning(f"Ignoring unreadable cache entry {path}")
+            self._count(kind, False)
+            return None
+
+        # bump the access time used for LRU eviction
+        os.utime(path)
+        self._count(kind, True)
+        return value
+
+    def put(self, kind: str, key: str, value: Union[str, Image.Image]):
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so a crash never leaves a truncated entry
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        if kind == "caption":
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(value)
+        else:
+            # string metadata such as the mask's salience center is kept as PNG text chunks
+            pnginfo = PngImagePlugin.PngInfo()
+            for k, v in value.info.items():
+                if isinstance(v, str):
+                    pnginfo.add_text(k, v)
+            value.save(tmp_path, format="PNG", pnginfo=pnginfo)
+        os.replace(tmp_path, path)
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in `max_size_bytes`.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            log.info(f"Evicted {removed} entries from the preprocess cache")
+
+    def report(self):
+        for kind, (hits, misses) in sorted(self.stats.items()):
+            log.info(f"Preprocess cache {kind}: {hits} hits, {misses} misses")
+        log.info(
+            f"Preprocess cache size: {self.size() / 1024**2:.1f} MB of {self.max_size_bytes / 1024**2:.1f} MB"
+        )
+
+
 @torch.no_grad()
 @torch.cuda.amp.autocast()
 def swin_ir_sr(
@@ -115,6 +353,7 @@ def swin_ir_sr(
     ] = "caidas/swin2SR-realworld-sr-x4-64-bsrgan-psnr",
     target_size: Optional[Tuple[int, int]] = None,
     device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"),
+    batch_size: int = 1,
     **kwargs,
 ) -> List[Image.Image]:
     """
@@ -122,37 +361,52 @@ def swin_ir_sr(
     If the image is already larger than the target size, it will not be upscaled
     and will be returned as is.
 
+    Images are upscaled `batch_size` at a time. Images of different sizes in the
+    same batch are padded to the largest one and cropped back after upscaling.
     """
 
-    model = Swin2SRForImageSuperResolution.from_pretrained(
-        model_id, cache_dir=MODEL_PATH
-    ).to(device)
-    processor = Swin2SRImageProcessor()
+    model = _load_pretrained(Swin2SRForImageSuperResolution, model_id, device)
+    window_size = model.config.window_size
+    upscale = model.config.upscale
 
-    out_images = []
+    out_images = list(images)
 
-    for image in tqdm(images):
+    to_upscale = []
+    for idx, image in enumerate(images):
         ori_w, ori_h = image.size
         if target_size is not None:
             # upscale only if width or height of image is smaller than target size
             log.debug(f'Image width: {ori_w}, Image height: {ori_h}, Target width: {target_size[0]}, Target height: {target_size[1]}' )
             if ori_w >= target_size[0] or ori_h >= target_size[1]:
-                out_images.append(image)
                 continue
+        to_upscale.append(idx)
+
+    for batch in tqdm(list(_batched(to_upscale, batch_size))):
+        log.info(f"Upscaling batch of {len(batch)} images...")
+        sizes = [images[idx].size for idx in batch]
+        max_w = max(w for w, _ in sizes)
+        max_h = max(h for _, h in sizes)
+        # pad to a multiple of the window size, like Swin2SRImageProcessor does
+        pad_w = (max_w // window_size + 1) * window_size
+        pad_h = (max_h // window_size + 1) * window_size
+
+        pixel_values = []
+        for idx, (w, h) in zip(batch, sizes):
+            x = torch.from_numpy(np.array(images[idx])).permute(2, 0, 1).float() / 255.0
+            x = torch.nn.functional.pad(
+                x.unsqueeze(0), (0, pad_w - w, 0, pad_h - h), mode="replicate"
+            )
+            pixel_values.append(x)
+        pixel_values = torch.cat(pixel_values).to(device)
 
-        log.info('Resizing...')
-        inputs = processor(image, return_tensors="pt").to(device)
-        with torch.no_grad():
-            outputs = model(**inputs)
-
-        output = (
-            outputs.reconstruction.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-        )
-        output = np.moveaxis(output, source=0, destination=-1)
-        output = (output * 255.0).round().astype(np.uint8)
-        output = Image.fromarray(output)
+        outputs = model(pixel_values=pixel_values)
 
-        out_images.append(output)
+        reconstruction = outputs.reconstruction.data.float().clamp_(0, 1)
+        for idx, (w, h), output in zip(batch, sizes, reconstruction):
+            output = output[:, : h * upscale, : w * upscale].cpu().numpy()
+            output = np.moveaxis(output, source=0, destination=-1)
+            output = (output * 255.0).round().astype(np.uint8)
+            out_images[idx] = Image.fromarray(output)
 
     return out_images
 
@@ -168,10 +422,16 @@ def clipseg_mask_generator(
     device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"),
     bias: float = 0.01,
     temp: float = 1.0,
+    batch_size: int = 1,
+    return_centers: bool = False,
     **kwargs,
-) -> List[Image.Image]:
+) -> Union[List[Image.Image], Tuple[List[Image.Image], List[Tuple[float, float]]]]:
     """
     Returns a greyscale mask for each image, where the mask is the probability of the target prompt being present in the image
+
+    With return_centers, the center of mass of every mask is also computed and (masks, centers) is
+    returned. It is taken from the final greyscale mask with _center_of_mass, so it is the same
+    center a crop computes from a cached mask.
     """
 
     if isinstance(target_prompts, str):
@@ -181,19 +441,23 @@ def clipseg_mask_generator(
 
         target_prompts = [target_prompts] * len(images)
 
-    processor = CLIPSegProcessor.from_pretrained(model_id, cache_dir=MODEL_PATH)
-    model = CLIPSegForImageSegmentation.from_pretrained(
-        model_id, cache_dir=MODEL_PATH
-    ).to(device)
+    processor = _load_pretrained(CLIPSegProcessor, model_id)
+    model = _load_pretrained(CLIPSegForImageSegmentation, model_id, device)
 
     masks = []
+    centers = []
 
-    for image, prompt in tqdm(zip(images, target_prompts)):
-        original_size = image.size
+    for batch in tqdm(list(_batched(list(zip(images, target_prompts)), batch_size))):
+        # every image is scored against its prompt and the empty prompt
+        texts = []
+        batch_images = []
+        for image, prompt in batch:
+            texts.extend([prompt, ""])
+            batch_images.extend([image] * 2)
 
         inputs = processor(
-            text=[prompt, ""],
-            images=[image] * 2,
+            text=texts,
+            images=batch_images,
             padding="max_length",
             truncation=True,
             return_tensors="pt",
@@ -202,18 +466,26 @@ def clipseg_mask_generator(
         outputs = model(**inputs)
 
         logits = outputs.logits
-        probs = torch.nn.functional.softmax(logits / temp, dim=0)[0]
+        logits = logits.view(len(batch), 2, *logits.shape[-2:])
+        probs = torch.nn.functional.softmax(logits / temp, dim=1)[:, 0]
         probs = (probs + bias).clamp_(0, 1)
-        probs = 255 * probs / probs.max()
+        probs = 255 * probs / probs.amax(dim=(-2, -1), keepdim=True)
 
-        # make mask greyscale
-        mask = Image.fromarray(probs.cpu().numpy()).convert("L")
+        probs = probs.cpu().numpy()
 
-        # resize mask to original size
-        mask = mask.resize(original_size)
+        for (image, _), prob in zip(batch, probs):
+            # make mask greyscale
+            mask = Image.fromarray(prob).convert("L")
 
-        masks.append(mask)
+            # resize mask to original size
+            mask = mask.resize(image.size)
 
+            masks.append(mask)
+            if return_centers:
+                centers.append(_center_of_mass(mask))
+
+    if return_centers:
+        return masks, centers
     return masks
 
 
@@ -227,34 +499,32 @@ def blip_captioning_dataset(
     ] = "Salesforce/blip-image-captioning-large",
     device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
     substitution_tokens: Optional[List[str]] = None,
+    batch_size: int = 1,
     **kwargs,
 ) -> List[str]:
     """
     Returns a list of captions for the given images
     """
-    processor = BlipProcessor.from_pretrained(model_id, cache_dir=MODEL_PATH)
-    model = BlipForConditionalGeneration.from_pretrained(
-        model_id, cache_dir=MODEL_PATH
-    ).to(device)
+    processor = _load_pretrained(BlipProcessor, model_id)
+    model = _load_pretrained(BlipForConditionalGeneration, model_id, device)
     captions = []
     text = text.strip()
     log.debug(f"Input captioning text: {text}")
-    for image in tqdm(images):
-        inputs = processor(image, return_tensors="pt").to("cuda")
+    for batch in tqdm(list(_batched(images, batch_size))):
+        inputs = processor(images=batch, return_tensors="pt").to(device)
         out = model.generate(
             **inputs, max_length=150, do_sample=True, top_k=50, temperature=0.7
         )
-        caption = processor.decode(out[0], skip_special_tokens=True)
-
-        # BLIP 2 lowercases all caps tokens. This should properly replace them w/o messing up subwords. I'm sure there's a better way to do this.
-        for token in substitution_tokens:
-            log.debug(token)
-            sub_cap = " " + caption + " "
-            log.debug(sub_cap)
-            sub_cap = sub_cap.replace(" " + token.lower() + " ", " " + token + " ")
-            caption = sub_cap.strip()
-
-        captions.append(text + " " + caption)
+        for caption in processor.batch_decode(out, skip_special_tokens=True):
+            # BLIP 2 lowercases all caps tokens. This should properly replace them w/o messing up subwords. I'm sure there's a better way to do this.
+            for token in substitution_tokens or []:
+                log.debug(token)
+                sub_cap = " " + caption + " "
+                log.debug(sub_cap)
+                sub_cap = sub_cap.replace(" " + token.lower() + " ", " " + token + " ")
+                caption = sub_cap.strip()
+
+            captions.append(text + " " + caption)
     for caption in captions:
         log.info(f"Generated caption: {str(caption)}")
     return captions
@@ -423,19 +693,80 @@ def _center_of_mass(mask: Image.Image):
     """
     Returns the center of mass of the mask
     """
-    x, y = np.meshgrid(np.arange(mask.size[0]), np.arange(mask.size[1]))
-    mask_np = np.array(mask) + 0.01
-    x_ = x * mask_np
-    y_ = y * mask_np
+    # Project the mask onto its rows and columns instead of weighting full-size
+    # coordinate grids; only the two marginals are ever materialized.
+    mask_np = np.asarray(mask)
+    h, w = mask_np.shape[:2]
+    cols = mask_np.sum(axis=0, dtype=np.float64) + 0.01 * h
+    rows = mask_np.sum(axis=1, dtype=np.float64) + 0.01 * w
+    total = cols.sum()
 
-    x = np.sum(x_) / np.sum(mask_np)
-    y = np.sum(y_) / np.sum(mask_np)
+    x = cols @ np.arange(w) / total
+    y = rows @ np.arange(h) / total
 
     return x, y
 
 
+def center_of_mass_tensor(masks: torch.Tensor) -> torch.Tensor:
+    """
+    Batched version of _center_of_mass for (..., H, W) mask tensors, e.g. on the GPU.
+    Returns a (..., 2) tensor of (x, y) centers.
+    """
+    h, w = masks.shape[-2:]
+    cols = masks.float().sum(dim=-2) + 0.01 * h
+    rows = masks.float().sum(dim=-1) + 0.01 * w
+    total = cols.sum(dim=-1)
+
+    x = (cols * torch.arange(w, device=masks.device)).sum(dim=-1) / total
+    y = (rows * torch.arange(h, device=masks.device)).sum(dim=-1) / total
+
+    return torch.stack([x, y], dim=-1)
+
+
+def _crop_image_and_mask(
+    image: Image.Image,
+    mask: Image.Image,
+    crop_based_on_salience: bool,
+    target_size: int,
+    com: Optional[Tuple[float, float]] = None,
+):
+    """
+    Crops the image and its mask to a square around the salient part. Runs in a worker process.
+    """
+    if crop_based_on_salience:
+        if com is None:
+            com = _center_of_mass(mask)
+    else:
+        com = (image.size[0] / 2, image.size[1] / 2)
+    image = _crop_to_square(image, com, resize_to=None)
+    mask = _crop_to_square(mask, com, resize_to=target_size)
+    return image, mask, (round(com[0], 3), round(com[1], 3))
+
+
+def _resize_square(image: Image.Image, target_size: int) -> Image.Image:
+    return image.resize((target_size, target_size), Image.Resampling.LANCZOS)
+
+
+def _save_image_and_mask(
+    image: Image.Image,
+    mask: Image.Image,
+    image_path: str,
+    mask_path: str,
+    image_format: str = "png",
+    png_compress_level: int = 6,
+):
+    """
+    Encodes and writes an image and its mask. Runs in a worker process.
+    """
+    for im, path in ((image, image_path), (mask, mask_path)):
+        if image_format == "webp":
+            im.save(path, format="WEBP", lossless=True, method=1)
+        else:
+            im.save(path, format="PNG", compress_level=png_compress_level)
+
+
 def load_and_save_masks_and_captions(
-    files: Union[str, List[str]],
+    files: Union[str, List[str], Iterable[Tuple[str, bytes]]],
     output_dir: str = TEMP_OUT_DIR,
     caption_text: Optional[str] = None,
     mask_target_prompts: Optional[Union[List[str], str]] = None,
@@ -445,11 +776,30 @@ def load_and_save_masks_and_captions(
     temp: float = 1.0,
     n_length: int = -1,
     substitution_tokens: Optional[List[str]] = None,
+    batch_size: int = 1,
+    queue_size: int = 2,
+    cache: Optional[PreprocessCache] = None,
+    num_workers: int = 0,
+    image_format: Literal["png", "webp"] = "png",
+    png_compress_level: int = 6,
 ):
     """
     Loads images from the given files, generates masks for them, and saves the masks and captions and upscale images
     to output dir. If mask_target_prompts is given, it will generate kinda-segmentation-masks for the prompts and save them as well.
 
+    `files` is a directory, a list of image paths or an iterable of (name, image bytes) such as
+    the one returned by iter_archive_images.
+
+    Images are streamed through the pipeline `batch_size` at a time with at most `queue_size` batches
+    waiting between two stages, so memory use does not grow with the number of images.
+
+    If a PreprocessCache is given, captions, masks and upscaled crops are looked up there first and
+    only the missing ones are computed.
+
+    With num_workers > 0, cropping, resizing and encoding run in a pool of worker processes instead
+    of one core. Images are written as PNG with `png_compress_level` (0-9, lower is faster) or as
+    lossless WebP with image_format="webp".
+
     Example:
     >>> x = load_and_save_masks_and_captions(
                 files="./data/images",
@@ -461,6 +811,7 @@ def load_and_save_masks_and_captions(
                 use_face_detection_instead=False,
                 temp=1.0,
                 n_length=-1,
+                batch_size=4,
             )
     """
     os.makedirs(output_dir, exist_ok=True)
@@ -484,82 +835,288 @@ def load_and_save_masks_and_captions(
             n_length = len(files)
         files = sorted(files)[:n_length]
         log.debug(files)
-    images = [Image.open(file).convert("RGB") for file in files]
-
-    # captions
-    log.info(f"Generating {len(images)} captions...")
-    captions = blip_captioning_dataset(
-        images, text=caption_text, substitution_tokens=substitution_tokens
-    )
+    elif n_length != -1:
+        files = itertools.islice(files, n_length)
 
     if mask_target_prompts is None:
         mask_target_prompts = ""
         temp = 999
 
-    log.info(f"Generating {len(images)} masks...")
-    if not use_face_detection_instead:
-        log.info(f"Using clipseg for masks...")
-        seg_masks = clipseg_mask_generator(
-            images=images, target_prompts=mask_target_prompts, temp=temp
-        )
-    else:
-        log.info(f"Using face detection for masks...")
-        seg_masks = face_mask_google_mediapipe(images=images)
-
-    # find the center of mass of the mask
-    log.info(f"Finding the center of mass of the mask...")
-    if crop_based_on_salience:
-        coms = [_center_of_mass(mask) for mask in seg_masks]
-    else:
-        coms = [(image.size[0] / 2, image.size[1] / 2) for image in images]
-    # based on the center of mass, crop the image to a square
-    images = [
-        _crop_to_square(image, com, resize_to=None) for image, com in zip(images, coms)
-    ]
-
-    log.info(f"Upscaling {len(images)} images...")
-    # upscale images anyways
-    images = swin_ir_sr(images, target_size=(target_size, target_size))
-    
-    # Is this needed? Should all images not already be the right size?
-    images = [
-        image.resize((target_size, target_size), Image.Resampling.LANCZOS)
-        for image in images
-    ]
-
-    seg_masks = [
-        _crop_to_square(mask, com, resize_to=target_size)
-        for mask, com in zip(seg_masks, coms)
-    ]
-
-    data = []
-
-    # clean TEMP_OUT_DIR first
+    # clean TEMP_OUT_DIR first. The trainer's latent cache is kept, it checks itself
+    # against the new images and is reused when they did not change.
     if os.path.exists(output_dir):
         for file in os.listdir(output_dir):
-            os.remove(os.path.join(output_dir, file))
+            if file == "latents_cache.safetensors":
+                continue
+            path = os.path.join(output_dir, file)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
 
     os.makedirs(output_dir, exist_ok=True)
 
-    # iterate through the images, masks, and captions and add a row to the dataframe for each
-    for idx, (image, mask, caption) in enumerate(zip(images, seg_masks, captions)):
-        image_name = f"{idx}.src.png"
-        mask_file = f"{idx}.mask.png"
+    # Images flow through the stages below `batch_size` at a time. Every stage runs in
+    # its own thread with a bounded queue in front of the next one, so only a few
+    # batches are ever held in memory and CPU decoding / PNG encoding overlaps with
+    # the GPU stages.
+
+    def cached(records, kind, field, key_fn):
+        """
+        Fills `field` from the cache for every record that has a `kind` entry and
+        returns the records that still have to be computed.
+        """
+        if cache is None:
+            return records
+        missing = []
+        for r in records:
+            r[f"{kind}_key"] = cache.key(r["hash"], *key_fn(r))
+            value = cache.get(kind, r[f"{kind}_key"])
+            if value is None:
+                missing.append(r)
+            else:
+                r[field] = value
+        return missing
+
+    def store(records, kind, field):
+        if cache is not None:
+            for r in records:
+                cache.put(kind, r[f"{kind}_key"], r[field])
+
+    def decode(batch):
+        records = []
+        for idx, file in batch:
+            if isinstance(file, tuple):
+                # (member name, bytes) streamed from an archive
+                data = file[1]
+            else:
+                with open(file, "rb") as f:
+                    data = f.read()
+            records.append(
+                {
+                    "idx": idx,
+                    "hash": hashlib.sha256(data).hexdigest(),
+                    "image": Image.open(io.BytesIO(data)).convert("RGB"),
+                }
+            )
+        return records
+
+    def caption(records):
+        missing = cached(
+            records,
+            "caption",
+            "caption",
+            lambda r: (CAPTION_MODEL_ID, caption_text, tuple(substitution_tokens or ())),
+        )
+        if missing:
+            captions = blip_captioning_dataset(
+                [r["image"] for r in missing],
+                text=caption_text,
+                model_id=CAPTION_MODEL_ID,
+                substitution_tokens=substitution_tokens,
+                batch_size=batch_size,
+            )
+            for r, c in zip(missing, captions):
+                r["caption"] = c
+            store(missing, "caption", "caption")
+        return records
+
+    def mask_prompt(r):
+        if isinstance(mask_target_prompts, str):
+            return mask_target_prompts
+        return mask_target_prompts[r["idx"]]
+
+    def mask(records):
+        if not use_face_detection_instead:
+            missing = cached(
+                records, "mask", "mask", lambda r: (MASK_MODEL_ID, mask_prompt(r), temp)
+            )
+        else:
+            missing = cached(records, "mask", "mask", lambda r: ("mediapipe",))
+        if missing:
+            images = [r["image"] for r in missing]
+            if not use_face_detection_instead:
+                seg_masks, centers = clipseg_mask_generator(
+                    images=images,
+                    target_prompts=[mask_prompt(r) for r in missing],
+                    model_id=MASK_MODEL_ID,
+                    temp=temp,
+                    batch_size=batch_size,
+                    return_centers=True,
+                )
+                # keep the salience center with the mask, it is saved along with it in the cache
+                for m, (x, y) in zip(seg_masks, centers):
+                    m.info["com"] = f"{x},{y}"
+            else:
+                seg_masks = face_mask_google_mediapipe(images=images)
+            for r, m in zip(missing, seg_masks):
+                r["mask"] = m
+            store(missing, "mask", "mask")
+        return records
+
+    def mask_center(r):
+        com = r["mask"].info.get("com")
+        if com is None:
+            return None
+        return tuple(float(c) for c in com.split(","))
+
+    def crop(records):
+        # based on the center of mass of the mask, crop the image to a square
+        cropped = pool_map(
+            _crop_image_and_mask,
+            [r["image"] for r in records],
+            [r["mask"] for r in records],
+            itertools.repeat(crop_based_on_salience),
+            itertools.repeat(target_size),
+            [mask_center(r) for r in records],
+        )
+        for r, (image, mask, com) in zip(records, cropped):
+            r["image"], r["mask"], r["crop"] = image, mask, com
+        return records
+
+    def upscale(records):
+        missing = cached(
+            records,
+            "upscale",
+            "image",
+            lambda r: (UPSCALE_MODEL_ID, target_size, r["crop"]),
+        )
+        if missing:
+            # upscale images anyways
+            images = swin_ir_sr(
+                [r["image"] for r in missing],
+                model_id=UPSCALE_MODEL_ID,
+                target_size=(target_size, target_size),
+                batch_size=batch_size,
+            )
+            # Is this needed? Should all images not already be the right size?
+            images = pool_map(_resize_square, images, itertools.repeat(target_size))
+            for r, image in zip(missing, images):
+                r["image"] = image
+            store(missing, "upscale", "image")
+        return records
+
+    def write(records):
+        rows = []
+        for r in records:
+            rows.append(
+                {
+                    "image_path": f"{r['idx']}.src.{image_format}",
+                    "mask_path": f"{r['idx']}.mask.{image_format}",
+                    "caption": r["caption"],
+                }
+            )
 
         # save the image and mask files
-        image.save(output_dir + image_name)
-        mask.save(output_dir + mask_file)
+        list(
+            pool_map(
+                _save_image_and_mask,
+                [r["image"] for r in records],
+                [r["mask"] for r in records],
+                [os.path.join(output_dir, row["image_path"]) for row in rows],
+                [os.path.join(output_dir, row["mask_path"]) for row in rows],
+                itertools.repeat(image_format),
+                itertools.repeat(png_compress_level),
+            )
+        )
+        return rows
+
+    n_files = len(files) if isinstance(files, list) else None
+    log.info(
+        f"Generating captions and {'face detection' if use_face_detection_instead else 'clipseg'} masks, "
+        f"cropping and upscaling {n_files if n_files is not None else 'streamed'} images..."
+    )
 
-        # add a new row to the dataframe with the file names and caption
-        data.append(
-            {"image_path": image_name, "mask_path": mask_file, "caption": caption},
+    # CPU-bound crop / resize / encode work goes to worker processes. They are spawned rather
+    # than forked so they never inherit the CUDA context or the locks held by the stage threads.
+    pool = None
+    pool_map = map
+    if num_workers > 0:
+        pool = ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
         )
+        pool_map = pool.map
+
+    stream = _batched(enumerate(files), batch_size)
+    for stage in (decode, caption, mask, crop, upscale, write):
+        stream = _stream_stage(stage, stream, queue_size=queue_size)
+
+    try:
+        data = []
+        total = math.ceil(n_files / max(1, batch_size)) if n_files is not None else None
+        for rows in tqdm(stream, total=total):
+            data.extend(rows)
+    finally:
+        # stops the stage threads if we failed half way, they would otherwise wait on their queues forever
+        stream.close()
+        if pool is not None:
+            pool.shutdown()
+
+    if len(data) == 0:
+        raise Exception("No images found in the input. It does not contain any image files.")
 
     df = pd.DataFrame(columns=["image_path", "mask_path", "caption"], data=data)
     # save the dataframe to a CSV file
     df.to_csv(os.path.join(output_dir, "captions.csv"), index=False)
 
 
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_STREAM_END = object()
+
+
+def _stream_stage(fn, upstream: Iterator, queue_size: int = 2) -> Iterator:
+    """
+    Applies `fn` to every item of `upstream` in a background thread and yields the results.
+    At most `queue_size` results are buffered, so chained stages run concurrently while
+    memory stays bounded. Exceptions raised in the stage are re-raised in the consumer.
+    When the consumer stops early (an exception or close()), the thread stops too and
+    closes `upstream`, so the whole chain of stages shuts down.
+    """
+    results = queue.Queue(maxsize=max(1, queue_size))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in upstream:
+                if not put(fn(item)):
+                    return
+            put(_STREAM_END)
+        except BaseException as e:
+            put(_StageError(e))
+        finally:
+            if hasattr(upstream, "close"):
+                upstream.close()
+
+    thread = threading.Thread(target=worker, name=f"preprocess-{fn.__name__}", daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = results.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+    thread.join()
+
+
 def _find_files(pattern, dir="."):
     """Return list of files matching pattern in a given directory, in absolute format.
     Unlike glob, this is case-insensitive.
@@ -0,0 +1,77 @@
+# Micro-benchmark for the salience center-of-mass used to crop training images.
+# Compares the original meshgrid implementation with the projection based one in
+# preprocess.py, on the CPU and batched on the GPU.
+#
+#   python script/benchmark_center_of_mass.py --width 3840 --height 2160 --batch 8
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from preprocess import _center_of_mass, center_of_mass_tensor
+
+
+def meshgrid_center_of_mass(mask: Image.Image):
+    # the implementation _center_of_mass replaced, kept here as the baseline
+    x, y = np.meshgrid(np.arange(mask.size[0]), np.arange(mask.size[1]))
+    mask_np = np.array(mask) + 0.01
+    x_ = x * mask_np
+    y_ = y * mask_np
+
+    x = np.sum(x_) / np.sum(mask_np)
+    y = np.sum(y_) / np.sum(mask_np)
+
+    return x, y
+
+
+def timeit(fn, repeats):
+    fn()  # warmup
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark center of mass implementations")
+    parser.add_argument("--width", type=int, default=3840, help="Mask width")
+    parser.add_argument("--height", type=int, default=2160, help="Mask height")
+    parser.add_argument("--batch", type=int, default=8, help="Number of masks per run")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed runs per implementation")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    masks_np = rng.integers(0, 256, (args.batch, args.height, args.width), dtype=np.uint8)
+    masks = [Image.fromarray(m) for m in masks_np]
+
+    print(f"meshgrid: {meshgrid_center_of_mass(masks[0])}, projection: {_center_of_mass(masks[0])}")
+
+    results = {
+        "meshgrid (cpu)": timeit(lambda: [meshgrid_center_of_mass(m) for m in masks], args.repeats),
+        "projection (cpu)": timeit(lambda: [_center_of_mass(m) for m in masks], args.repeats),
+    }
+
+    if torch.cuda.is_available():
+        masks_gpu = torch.from_numpy(masks_np).cuda()
+        results["projection batched (gpu)"] = timeit(
+            lambda: center_of_mass_tensor(masks_gpu).cpu(), args.repeats
+        )
+
+    print(f"{args.batch} masks of {args.width}x{args.height}:")
+    for name, seconds in results.items():
+        print(f"  {name:<28} {seconds * 1000:9.2f} ms  ({seconds * 1000 / args.batch:.2f} ms/mask)")
+
+
+if __name__ == "__main__":
+    main()
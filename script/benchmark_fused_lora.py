@@ -0,0 +1,101 @@
+# Per-step latency of the SDXL unet with a trained LoRA, run through the LoRA attention
+# processors (unfused) and merged into the attention weights (fused, see FusedLora in
+# predict.py). Also reports how far the fused outputs are from the unfused ones.
+#
+#   python script/benchmark_fused_lora.py --lora ./training_out/lora.safetensors --steps 20
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from diffusers import UNet2DConditionModel
+from safetensors.torch import load_file
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from predict import SDXL_MODEL_CACHE, FusedLora, build_lora_attn_procs
+
+
+def time_steps(unet, inputs, steps, cross_attention_kwargs=None):
+    def step():
+        return unet(**inputs, cross_attention_kwargs=cross_attention_kwargs).sample
+
+    sample = step()  # warmup
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps, sample
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fused vs unfused LoRA inference")
+    parser.add_argument("--lora", type=str, default="./training_out/lora.safetensors", help="LoRA weights")
+    parser.add_argument("--model", type=str, default=SDXL_MODEL_CACHE, help="SDXL model directory")
+    parser.add_argument("--width", type=int, default=1024, help="Image width")
+    parser.add_argument("--height", type=int, default=1024, help="Image height")
+    parser.add_argument("--batch", type=int, default=2, help="Unet batch size (2 = one image with cfg)")
+    parser.add_argument("--steps", type=int, default=20, help="Timed unet steps per mode")
+    parser.add_argument("--lora_scale", type=float, default=0.6, help="LoRA scale")
+    args = parser.parse_args()
+
+    unet = UNet2DConditionModel.from_pretrained(
+        args.model, subfolder="unet", torch_dtype=torch.float16, variant="fp16", use_safetensors=True
+    ).to("cuda")
+    procs = build_lora_attn_procs(unet, load_file(args.lora), "cuda")
+    unet.set_attn_processor(dict(procs))
+
+    generator = torch.Generator("cuda").manual_seed(0)
+    inputs = {
+        "sample": torch.randn(
+            (args.batch, unet.config.in_channels, args.height // 8, args.width // 8),
+            generator=generator,
+            device="cuda",
+            dtype=torch.float16,
+        ),
+        "timestep": torch.tensor(500, device="cuda"),
+        "encoder_hidden_states": torch.randn(
+            (args.batch, 77, unet.config.cross_attention_dim),
+            generator=generator,
+            device="cuda",
+            dtype=torch.float16,
+        ),
+        "added_cond_kwargs": {
+            "text_embeds": torch.randn((args.batch, 1280), generator=generator, device="cuda", dtype=torch.float16),
+            "time_ids": torch.tensor(
+                [[args.height, args.width, 0, 0, args.height, args.width]] * args.batch,
+                device="cuda",
+                dtype=torch.float16,
+            ),
+        },
+    }
+
+    with torch.inference_mode():
+        unfused, unfused_sample = time_steps(
+            unet, inputs, args.steps, cross_attention_kwargs={"scale": args.lora_scale}
+        )
+
+        fused_lora = FusedLora(unet, procs)
+        start = time.perf_counter()
+        fused_lora.fuse(args.lora_scale)
+        torch.cuda.synchronize()
+        fuse_time = time.perf_counter() - start
+        fused, fused_sample = time_steps(unet, inputs, args.steps)
+
+        start = time.perf_counter()
+        fused_lora.unfuse()
+        torch.cuda.synchronize()
+        unfuse_time = time.perf_counter() - start
+
+    error = (fused_sample.float() - unfused_sample.float()).abs().max().item()
+    print(f"{args.width}x{args.height}, batch {args.batch}, lora scale {args.lora_scale}:")
+    print(f"  unfused  {unfused * 1000:9.2f} ms/step")
+    print(f"  fused    {fused * 1000:9.2f} ms/step  ({(1 - fused / unfused) * 100:.1f}% faster)")
+    print(f"  fuse {fuse_time * 1000:.0f} ms, unfuse {unfuse_time * 1000:.0f} ms, max abs diff {error:.4f}")
+
+
+if __name__ == "__main__":
+    main()
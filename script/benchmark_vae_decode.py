@@ -0,0 +1,69 @@
+# Latency and peak memory of the SDXL vae decode across resolutions, in one shot and with
+# the tiled (and batch sliced) decode predict.py enables with VAE_TILING / VAE_SLICING.
+#
+#   python script/benchmark_vae_decode.py --sizes 1024 1536 2048 3072 --batch 1
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from diffusers import AutoencoderKL
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from predict import SDXL_MODEL_CACHE, configure_vae
+
+
+def run(vae, latents, repeats):
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats()
+    vae.decode(latents)  # warmup
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        vae.decode(latents)
+    torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats, torch.cuda.max_memory_allocated()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark full vs tiled vae decode")
+    parser.add_argument("--model", type=str, default=SDXL_MODEL_CACHE, help="SDXL model directory")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 1536, 2048, 3072], help="Square image sizes")
+    parser.add_argument("--batch", type=int, default=1, help="Images per decode")
+    parser.add_argument("--tile_size", type=int, default=1024, help="Tile size in pixels")
+    parser.add_argument("--tile_overlap", type=float, default=0.25, help="Tile overlap factor")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed decodes per configuration")
+    args = parser.parse_args()
+
+    vae = AutoencoderKL.from_pretrained(
+        args.model, subfolder="vae", torch_dtype=torch.float16, use_safetensors=True
+    ).to("cuda")
+    modes = {
+        "full": dict(tiling=False, slicing=False),
+        "tiled": dict(tiling=True, slicing=False),
+        "tiled + sliced": dict(tiling=True, slicing=True),
+    }
+
+    print(f"batch {args.batch}, tile {args.tile_size}px, overlap {args.tile_overlap}:")
+    for size in args.sizes:
+        latents = torch.randn(
+            (args.batch, vae.config.latent_channels, size // 8, size // 8),
+            device="cuda",
+            dtype=torch.float16,
+        )
+        for name, mode in modes.items():
+            configure_vae(vae, tile_size=args.tile_size, tile_overlap=args.tile_overlap, **mode)
+            try:
+                with torch.inference_mode():
+                    seconds, peak = run(vae, latents, args.repeats)
+                result = f"{seconds * 1000:9.1f} ms  {peak / 2**30:6.2f} GiB peak"
+            except torch.cuda.OutOfMemoryError:
+                result = "out of memory"
+            print(f"  {size}px {name:<16} {result}")
+
+
+if __name__ == "__main__":
+    main()
@@ -46,10 +46,11 @@ def train(
         description="Number of individual training steps. Takes precedence over num_train_epochs",
         default=1000,
     ),
-    # gradient_accumulation_steps: int = Input(
-    #     description="Number of training steps to accumulate before a backward pass. Effective batch size = gradient_accumulation_steps * batch_size",
-    #     default=1,
-    # ), # todo.
+    gradient_accumulation_steps: int = Input(
+        description="Number of training steps to accumulate before a backward pass. Effective batch size = gradient_accumulation_steps * batch_size",
+        default=1,
+        ge=1,
+    ),
     is_lora: bool = Input(
         description="Whether to use LoRA training. If set to False, will use Full fine tuning",
         default=True,
@@ -119,6 +120,35 @@ def train(
         description="When should training should pivot from TI to LoRA/ Default is midway (0.5)",
         default=0.5,
     ),
+    preprocess_batch_size: int = Input(
+        description="Number of images captioned, masked and upscaled together during preprocessing. Higher values are faster but use more VRAM.",
+        default=4,
+        ge=1,
+    ),
+    use_preprocess_cache: bool = Input(
+        description="Reuse captions, masks and upscaled images computed for the same images by previous runs.",
+        default=True,
+    ),
+    stream_input_archive: bool = Input(
+        description="Decode images directly from the zip/tar instead of extracting them to disk first.",
+        default=True,
+    ),
+    preprocess_num_workers: int = Input(
+        description="Number of worker processes used to crop, resize and save images during preprocessing. 0 does this work in the main process.",
+        default=4,
+        ge=0,
+    ),
+    preprocess_image_format: str = Input(
+        description="Format of the preprocessed images. `webp` is lossless WebP.",
+        default="png",
+        choices=["png", "webp"],
+    ),
+    preprocess_png_compress_level: int = Input(
+        description="PNG compression level of the preprocessed images, from 0 (fastest, largest) to 9 (slowest, smallest).",
+        default=6,
+        ge=0,
+        le=9,
+    ),
     input_images_filetype: str = Input(
         description="Filetype of the input images. Can be either `zip` or `tar`. By default its `infer`, and it will be inferred from the ext of input file.",
         default="infer",
@@ -167,6 +197,12 @@ def train(
         use_face_detection_instead=use_face_detection_instead,
         temp=clipseg_temperature,
         substitution_tokens=list(token_dict.keys()),
+        batch_size=preprocess_batch_size,
+        use_cache=use_preprocess_cache,
+        stream_archive=stream_input_archive,
+        num_workers=preprocess_num_workers,
+        image_format=preprocess_image_format,
+        png_compress_level=preprocess_png_compress_level,
     )
 
     if not os.path.exists(SDXL_MODEL_CACHE):
@@ -187,7 +223,7 @@ def train(
         train_batch_size=train_batch_size,
         num_train_epochs=num_train_epochs,
         max_train_steps=max_train_steps,
-        gradient_accumulation_steps=1,
+        gradient_accumulation_steps=gradient_accumulation_steps,
         unet_learning_rate=unet_learning_rate,
         ti_lr=ti_lr,
         lora_lr=lora_lr,
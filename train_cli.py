@@ -8,6 +8,7 @@ def main():
     parser.add_argument("--checkpointing_steps", type=int, default=999999, help="Number of steps between saving checkpoints. Set to very very high number to disable checkpointing, because you don't need one.")
     parser.add_argument("--clipseg_temperature", type=float, default=1.0, help="How blurry you want the CLIPSeg mask to be. We recommend this value be something between `0.5` to `1.0`. If you want to have more sharp mask (but thus more errorful), you can decrease this value.")
     parser.add_argument("--crop_based_on_salience", action="store_true", help="If you want to crop the image to `target_size` based on the important parts of the image, set this to True. If you want to crop the image based on face detection, set this to False")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=1, help="Number of training steps to accumulate before a backward pass. Effective batch size = gradient_accumulation_steps * batch_size")
     parser.add_argument("--input_images", required=True, type=str, help="A .zip or .tar file containing the image files that will be used for fine-tuning")
     parser.add_argument("--input_images_filetype", type=str, choices=["zip", "tar", "infer"], default="infer", help="Filetype of the input images. Can be either `zip` or `tar`. By default its `infer`, and it will be inferred from the ext of input file.")
     parser.add_argument("--is_lora", action="store_true", help="Whether to use LoRA training. If set to False, will use Full fine tuning")
@@ -22,6 +23,12 @@ def main():
     parser.add_argument("--output_embedding_dir", type=str, default="constant", help="Path to embedding directory")
     parser.add_argument("--output_name", type=str, default="constant", help="Name of the model")
     parser.add_argument("--pivot_ratio", type=float, default=0.5, help="When should training should pivot from TI to LoRA/ Default is midway (0.5)")
+    parser.add_argument("--preprocess_batch_size", type=int, default=4, help="Number of images captioned, masked and upscaled together during preprocessing. Higher values are faster but use more VRAM.")
+    parser.add_argument("--extract_input_archive", action="store_true", help="Extract the zip/tar to disk before preprocessing instead of decoding the images directly from the archive.")
+    parser.add_argument("--no_preprocess_cache", action="store_true", help="Recompute captions, masks and upscaled images instead of reusing the ones cached by previous runs.")
+    parser.add_argument("--preprocess_num_workers", type=int, default=4, help="Number of worker processes used to crop, resize and save images during preprocessing. 0 does this work in the main process.")
+    parser.add_argument("--preprocess_image_format", type=str, choices=["png", "webp"], default="png", help="Format of the preprocessed images. `webp` is lossless WebP.")
+    parser.add_argument("--preprocess_png_compress_level", type=int, default=6, help="PNG compression level of the preprocessed images, from 0 (fastest, largest) to 9 (slowest, smallest).")
     parser.add_argument("--resolution", type=int, default=768, help="Square pixel resolution which your images will be resized to for training")
     parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible training. Leave empty to use a random seed")
     parser.add_argument("--ti_lr", type=float, default=3e-4, help="Scaling of learning rate for training textual inversion embeddings. Don't alter unless you know what you're doing.")
@@ -40,6 +47,7 @@ def main():
         train_batch_size=args.train_batch_size,
         num_train_epochs=args.num_train_epochs,
         max_train_steps=args.max_train_steps,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
         is_lora=args.is_lora,
         unet_learning_rate=args.unet_learning_rate,
         ti_lr=args.ti_lr,
@@ -56,6 +64,12 @@ def main():
         verbose=args.verbose,
         checkpointing_steps=args.checkpointing_steps,
         pivot_ratio=args.pivot_ratio,
+        preprocess_batch_size=args.preprocess_batch_size,
+        use_preprocess_cache=not args.no_preprocess_cache,
+        stream_input_archive=not args.extract_input_archive,
+        preprocess_num_workers=args.preprocess_num_workers,
+        preprocess_image_format=args.preprocess_image_format,
+        preprocess_png_compress_level=args.preprocess_png_compress_level,
         input_images_filetype=args.input_images_filetype,
         output_name=args.output_name,
         output_lora_dir=args.output_lora_dir,
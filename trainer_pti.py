@@ -22,6 +22,73 @@ from dataset_and_utils import (
 )
 
 
+def encode_tokens(text_encoders, tok1: torch.Tensor, tok2: torch.Tensor):
+    """
+    Runs both SDXL text encoders on a batch of token ids and returns
+    (prompt_embeds, pooled_prompt_embeds).
+    """
+    prompt_embeds_list = []
+    for tok, text_encoder in zip((tok1, tok2), text_encoders):
+        prompt_embeds_out = text_encoder(
+            tok.to(text_encoder.device),
+            output_hidden_states=True,
+        )
+
+        pooled_prompt_embeds = prompt_embeds_out[0]
+        prompt_embeds = prompt_embeds_out.hidden_states[-2]
+        bs_embed, seq_len, _ = prompt_embeds.shape
+        prompt_embeds = prompt_embeds.view(bs_embed, seq_len, -1)
+        prompt_embeds_list.append(prompt_embeds)
+
+    prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
+    pooled_prompt_embeds = pooled_prompt_embeds.view(bs_embed, -1)
+
+    return prompt_embeds, pooled_prompt_embeds
+
+
+class TextEmbeddingsCache:
+    """
+    Text encoder outputs for every distinct caption of the dataset, keyed by token ids.
+    Only valid while the token embeddings are frozen.
+    """
+
+    def __init__(self):
+        self.prompt_embeds = {}
+        self.pooled_prompt_embeds = {}
+
+    @staticmethod
+    def _key(tok1: torch.Tensor, tok2: torch.Tensor) -> bytes:
+        return tok1.cpu().numpy().tobytes() + tok2.cpu().numpy().tobytes()
+
+    @classmethod
+    @torch.no_grad()
+    def build(cls, text_encoders, dataset, batch_size: int = 16):
+        cache = cls()
+        unique = {}
+        for idx in range(len(dataset)):
+            (tok1, tok2), _, _ = dataset[idx]
+            unique.setdefault(cls._key(tok1, tok2), (tok1, tok2))
+
+        items = list(unique.items())
+        for start in range(0, len(items), batch_size):
+            batch = items[start : start + batch_size]
+            tok1 = torch.stack([toks[0] for _, toks in batch])
+            tok2 = torch.stack([toks[1] for _, toks in batch])
+            prompt_embeds, pooled_prompt_embeds = encode_tokens(text_encoders, tok1, tok2)
+            for (key, _), pe, ppe in zip(batch, prompt_embeds, pooled_prompt_embeds):
+                cache.prompt_embeds[key] = pe
+                cache.pooled_prompt_embeds[key] = ppe
+
+        print(f"# PTI :  Cached text encoder outputs for {len(items)} captions")
+        return cache
+
+    def lookup(self, tok1: torch.Tensor, tok2: torch.Tensor, device):
+        keys = [self._key(t1, t2) for t1, t2 in zip(tok1, tok2)]
+        prompt_embeds = torch.stack([self.prompt_embeds[k] for k in keys])
+        pooled_prompt_embeds = torch.stack([self.pooled_prompt_embeds[k] for k in keys])
+        return prompt_embeds.to(device), pooled_prompt_embeds.to(device)
+
+
 def main(
     pretrained_model_name_or_path: Optional[
         str
@@ -40,7 +107,7 @@ def main(
     num_train_epochs: int = 600,
     max_train_steps: Optional[int] = None,
     checkpointing_steps: int = 500000,  # default to no checkpoints
-    gradient_accumulation_steps: int = 1,  # todo
+    gradient_accumulation_steps: int = 1,
     unet_learning_rate: float = 1e-5,
     ti_lr: float = 3e-4,
     lora_lr: float = 1e-4,
@@ -51,7 +118,8 @@ def main(
     lr_num_cycles: int = 1,
     lr_power: float = 1.0,
     dataloader_num_workers: int = 0,
-    max_grad_norm: float = 1.0,  # todo with tests
+    vae_batch_size: int = 8,
+    max_grad_norm: float = 1.0,
     allow_tf32: bool = True,
     mixed_precision: Optional[str] = "bf16",
     device: str = "cuda:0",
@@ -61,6 +129,9 @@ def main(
     is_lora: bool = True,
     lora_rank: int = 32,
     pivot_ratio: float = 0.5,
+    cache_text_embeddings_after_pivot: bool = True,
+    offload_text_encoders: bool = False,
+    profile_retract_embeddings: bool = False,
 ) -> None:
     if allow_tf32:
         torch.backends.cuda.matmul.allow_tf32 = True
@@ -98,6 +169,7 @@ def main(
         [text_encoder_one, text_encoder_two], [tokenizer_one, tokenizer_two]
     )
     embedding_handler.initialize_new_tokens(inserting_toks=inserting_list_tokens)
+    embedding_handler.profile_retract = profile_retract_embeddings
 
     text_encoders = [text_encoder_one, text_encoder_two]
 
@@ -205,6 +277,7 @@ def main(
         vae.float(),
         do_cache=True,
         substitute_caption_map=token_dict,
+        vae_batch_size=vae_batch_size,
     )
 
     print("# PTI : Loaded dataset")
@@ -214,6 +287,7 @@ def main(
         batch_size=train_batch_size,
         shuffle=True,
         num_workers=dataloader_num_workers,
+        pin_memory=True,
     )
 
     num_update_steps_per_epoch = math.ceil(
@@ -225,8 +299,8 @@ def main(
     lr_scheduler = get_scheduler(
         lr_scheduler,
         optimizer=optimizer,
-        num_warmup_steps=lr_warmup_steps * gradient_accumulation_steps,
-        num_training_steps=max_train_steps * gradient_accumulation_steps,
+        num_warmup_steps=lr_warmup_steps,
+        num_training_steps=max_train_steps,
         num_cycles=lr_num_cycles,
         power=lr_power,
     )
@@ -262,6 +336,12 @@ def main(
     os.makedirs(f"{checkpoint_dir}/unet", exist_ok=True)
     os.makedirs(f"{checkpoint_dir}/embeddings", exist_ok=True)
 
+    text_embeds_cache = None
+
+    # Mixed precision: run the forward passes under autocast. The text encoder embeddings
+    # are trained in weight_dtype directly, so there is no loss scaling.
+    use_autocast = mixed_precision in ("fp16", "bf16")
+
     for epoch in range(first_epoch, num_train_epochs):
         if pivot_halfway:
             if epoch == math.ceil(num_train_epochs * pivot_ratio):
@@ -273,79 +353,113 @@ def main(
                     weight_decay=1e-4,
                 )
 
+                if cache_text_embeddings_after_pivot:
+                    # the embeddings are frozen from now on, so every caption always
+                    # encodes to the same thing: encode them once and drop the text
+                    # encoders from the step loop.
+                    print("# PTI :  Caching text encoder outputs")
+                    for param in text_encoder_parameters:
+                        param.requires_grad_(False)
+                    text_embeds_cache = TextEmbeddingsCache.build(
+                        text_encoders, train_dataset
+                    )
+                    if offload_text_encoders:
+                        for text_encoder in text_encoders:
+                            text_encoder.to("cpu")
+                        torch.cuda.empty_cache()
+
         unet.train()
         for step, batch in enumerate(train_dataloader):
-            progress_bar.update(1)
-            progress_bar.set_description(f"# PTI :step: {global_step}, epoch: {epoch}")
-            global_step += 1
-
             (tok1, tok2), vae_latent, mask = batch
-            vae_latent = vae_latent.to(weight_dtype)
-
-            # tokens to text embeds
-            prompt_embeds_list = []
-            for tok, text_encoder in zip((tok1, tok2), text_encoders):
-                prompt_embeds_out = text_encoder(
-                    tok.to(text_encoder.device),
-                    output_hidden_states=True,
-                )
+            vae_latent = vae_latent.to(device, dtype=weight_dtype, non_blocking=True)
+            mask = mask.to(device, non_blocking=True)
 
-                pooled_prompt_embeds = prompt_embeds_out[0]
-                prompt_embeds = prompt_embeds_out.hidden_states[-2]
-                bs_embed, seq_len, _ = prompt_embeds.shape
-                prompt_embeds = prompt_embeds.view(bs_embed, seq_len, -1)
-                prompt_embeds_list.append(prompt_embeds)
+            with torch.autocast(
+                device_type=torch.device(device).type,
+                dtype=weight_dtype,
+                enabled=use_autocast,
+            ):
+                # tokens to text embeds
+                if text_embeds_cache is not None:
+                    prompt_embeds, pooled_prompt_embeds = text_embeds_cache.lookup(
+                        tok1, tok2, device
+                    )
+                else:
+                    prompt_embeds, pooled_prompt_embeds = encode_tokens(
+                        text_encoders, tok1, tok2
+                    )
+                bs_embed = prompt_embeds.shape[0]
 
-            prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
-            pooled_prompt_embeds = pooled_prompt_embeds.view(bs_embed, -1)
+                # Create Spatial-dimensional conditions.
 
-            # Create Spatial-dimensional conditions.
+                original_size = (resolution, resolution)
+                target_size = (resolution, resolution)
+                crops_coords_top_left = (crops_coords_top_left_h, crops_coords_top_left_w)
+                add_time_ids = list(original_size + crops_coords_top_left + target_size)
+                add_time_ids = torch.tensor([add_time_ids])
 
-            original_size = (resolution, resolution)
-            target_size = (resolution, resolution)
-            crops_coords_top_left = (crops_coords_top_left_h, crops_coords_top_left_w)
-            add_time_ids = list(original_size + crops_coords_top_left + target_size)
-            add_time_ids = torch.tensor([add_time_ids])
+                add_time_ids = add_time_ids.to(device, dtype=prompt_embeds.dtype).repeat(
+                    bs_embed, 1
+                )
 
-            add_time_ids = add_time_ids.to(device, dtype=prompt_embeds.dtype).repeat(
-                bs_embed, 1
-            )
+                added_kw = {"text_embeds": pooled_prompt_embeds, "time_ids": add_time_ids}
 
-            added_kw = {"text_embeds": pooled_prompt_embeds, "time_ids": add_time_ids}
+                # Sample noise that we'll add to the latents
+                noise = torch.randn_like(vae_latent)
+                bsz = vae_latent.shape[0]
 
-            # Sample noise that we'll add to the latents
-            noise = torch.randn_like(vae_latent)
-            bsz = vae_latent.shape[0]
+                timesteps = torch.randint(
+                    0,
+                    noise_scheduler.config.num_train_timesteps,
+                    (bsz,),
+                    device=vae_latent.device,
+                )
+                timesteps = timesteps.long()
 
-            timesteps = torch.randint(
-                0,
-                noise_scheduler.config.num_train_timesteps,
-                (bsz,),
-                device=vae_latent.device,
-            )
-            timesteps = timesteps.long()
+                noisy_model_input = noise_scheduler.add_noise(vae_latent, noise, timesteps)
 
-            noisy_model_input = noise_scheduler.add_noise(vae_latent, noise, timesteps)
+                # Predict the noise residual
+                model_pred = unet(
+                    noisy_model_input,
+                    timesteps,
+                    prompt_embeds,
+                    added_cond_kwargs=added_kw,
+                ).sample
 
-            # Predict the noise residual
-            model_pred = unet(
-                noisy_model_input,
-                timesteps,
-                prompt_embeds,
-                added_cond_kwargs=added_kw,
-            ).sample
+            # the last window of an epoch may have fewer micro-batches
+            window_start = step - step % gradient_accumulation_steps
+            window_size = min(gradient_accumulation_steps, len(train_dataloader) - window_start)
 
-            loss = (model_pred - noise).pow(2) * mask
-            loss = loss.mean()
+            loss = (model_pred.float() - noise.float()).pow(2) * mask
+            loss = loss.mean() / window_size
 
             loss.backward()
+
+            # only step the optimizer once enough micro-batches were accumulated,
+            # or at the end of the epoch
+            if (step + 1) % gradient_accumulation_steps != 0 and step + 1 != len(
+                train_dataloader
+            ):
+                continue
+
+            if max_grad_norm is not None and max_grad_norm > 0:
+                torch.nn.utils.clip_grad_norm_(
+                    [p for group in optimizer.param_groups for p in group["params"]],
+                    max_grad_norm,
+                )
+
             optimizer.step()
             lr_scheduler.step()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
+
+            progress_bar.update(1)
+            progress_bar.set_description(f"# PTI :step: {global_step}, epoch: {epoch}")
+            global_step += 1
 
             # every step, we reset the embeddings to the original embeddings.
+            # Not needed once they are frozen and the text encoder outputs are cached.
 
-            for idx, text_encoder in enumerate(text_encoders):
+            if text_embeds_cache is None:
                 embedding_handler.retract_embeddings()
 
             if global_step % checkpointing_steps == 0:
@@ -374,6 +488,13 @@ def main(
                     f"{output_embedding_dir}/{output_name}-{global_step}.safetensors",
                 )
 
+    if profile_retract_embeddings and embedding_handler.retract_timings:
+        timings = embedding_handler.retract_timings
+        print(
+            f"# PTI :  retract_embeddings: {len(timings)} calls, "
+            f"{1000 * sum(timings) / len(timings):.3f} ms/step avg, {1000 * max(timings):.3f} ms max"
+        )
+
     # final_save
     print("Saving final model for return")
     if not is_lora: